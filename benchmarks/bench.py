@@ -0,0 +1,153 @@
+"""Per-stage timings of proto-sketch on synthetic protocols.
+
+Each case is a synthetic protocol of ACTORSxDRAWS. The stages are timed
+separately: parse, rasterize against a cold and a warm cache, layout,
+drawing and svg serialization. The output size is recorded too. Results are
+written as JSON and can be compared with the results of another commit.
+
+    python benchmarks/bench.py [--sizes 4x20 8x100] [-o results.json]
+    python benchmarks/bench.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import statistics
+import subprocess
+from io import BytesIO
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from core.setting import Options  # noqa: E402
+from core.parser import ProtoParser  # noqa: E402
+from core.svg import Renderer, write_svg  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+DEFAULT_SIZES = ["4x20", "8x100"]
+STAGES = ["parse", "rasterize_cold", "rasterize_warm", "layout", "draw", "serialize"]
+
+
+def timed(func, repeat):
+    # median seconds of repeat runs and the result of the last one
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times), result
+
+
+def run_case(source, options, repeat):
+    renderer = Renderer(options)
+    parse = lambda: ProtoParser().parse(source)
+    results = {}
+    results["parse"], proto = timed(parse, repeat)
+
+    # the cache folder starts empty, so the first pass rasterizes every message
+    results["rasterize_cold"], messages = timed(lambda: renderer.warm_cache(parse()), 1)
+    results["rasterize_warm"], _ = timed(lambda: renderer.warm_cache(parse()), repeat)
+
+    def layout():
+        proto = parse()
+        start = time.perf_counter()
+        proto.preprocess(renderer=renderer)
+        return time.perf_counter() - start
+    results["layout"] = statistics.median(layout() for _ in range(repeat))
+
+    def draw():
+        proto = parse()
+        start = time.perf_counter()
+        dwg = renderer.create_drawing(proto)
+        return time.perf_counter() - start, dwg
+    draws = [draw() for _ in range(repeat)]
+    results["draw"] = statistics.median(seconds for seconds, _ in draws)
+
+    def serialize():
+        buffer = BytesIO()
+        write_svg(draws[-1][1], buffer)
+        return buffer.getvalue()
+    results["serialize"], svg = timed(serialize, repeat)
+
+    results["messages"] = messages
+    results["svg_bytes"] = len(svg)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(before_file, after_file):
+    with open(before_file, "r", encoding="utf8") as f:
+        before = json.load(f)
+    with open(after_file, "r", encoding="utf8") as f:
+        after = json.load(f)
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    for case, results in after["cases"].items():
+        if case not in before["cases"]:
+            continue
+        print(case)
+        for key in STAGES + ["svg_bytes"]:
+            old, new = before["cases"][case].get(key), results.get(key)
+            if not old or new is None:
+                continue
+            unit = "B" if key == "svg_bytes" else "ms"
+            scale = 1 if key == "svg_bytes" else 1000
+            print(f"  {key:<16} {old * scale:>12.1f}{unit} {new * scale:>12.1f}{unit}  x{new / old:.2f}")
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark the stages of proto-sketch on synthetic protocols.")
+    parser.add_argument("--sizes", type=str, nargs='+', default=DEFAULT_SIZES,
+                        help=f"Cases as ACTORSxDRAWS (default: {' '.join(DEFAULT_SIZES)})")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs of the repeated stages (default: 5)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic protocols (default: 0)")
+    parser.add_argument("--flat", action="store_true", help="Benchmark the flat svg output")
+    parser.add_argument("--vector-text", action="store_true", help="Draw plain messages as svg text")
+    parser.add_argument("--vector-math", action="store_true", help="Draw formulas as glyph outlines")
+    parser.add_argument("-o", "--output", type=str, help="Write the results as JSON to this file")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="Compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "svg": {"flat": args.flat, "vector_text": args.vector_text, "vector_math": args.vector_math},
+        "cases": {},
+    }
+    for size in args.sizes:
+        actors, draws = [int(n) for n in size.lower().split("x")]
+        source = generate(actors, draws, seed=args.seed)
+        with tempfile.TemporaryDirectory() as work:
+            options = Options()
+            options.folder["cache"] = os.path.join(work, "cache")
+            options.svg.update(report["svg"])
+            results = run_case(source, options, args.repeat)
+        report["cases"][size] = results
+        print(f"{size:>10}  " + "  ".join(f"{stage} {results[stage] * 1000:.1f}ms" for stage in STAGES) +
+              f"  svg {results['svg_bytes'] / 1024:.1f}KB", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Startup time of the proto-sketch command line.
+
+Each case runs the CLI in a fresh interpreter and reports the median wall
+time, and which heavy modules it imported. Formatting runs against a warm
+cache, the way an editor integration calls it.
+
+    python benchmarks/startup.py [--repeat N] [--json] [--check]
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import statistics
+import subprocess
+from argparse import ArgumentParser
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ["matplotlib", "PIL", "numpy", "svgwrite"]
+
+DEMO = r'''protocol demo
+
+actor A
+actor B
+
+A->B:
+    "\"Hello B!\", $message_1$"
+
+B:
+"
+    Got $message_1$
+    Calculate $\int_{a}^{b} x^2 dx$
+"
+
+B->A: "ack"
+'''
+
+# run the cli in a fresh interpreter, then report the heavy modules it loaded
+SNIPPET = """
+import sys
+sys.path.insert(0, {root!r})
+sys.argv = ["proto-sketch"] + {args!r}
+from core.cli import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.stderr.write("\\nHEAVY:" + ",".join(name for name in {heavy!r} if name in sys.modules))
+"""
+
+CASES = {
+    "python": None,
+    "version": ["-v"],
+    "options-help": ["--options-help"],
+    "format": ["-f", "demo.proto", "-t"],
+}
+
+# cases that must not import any of HEAVY_MODULES
+FAST_CASES = ["version", "options-help", "format"]
+
+
+def run(args, cwd):
+    code = "pass" if args is None else SNIPPET.format(root=ROOT, args=args, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    seconds = time.perf_counter() - start
+    heavy = []
+    if "HEAVY:" in result.stderr:
+        heavy = [name for name in result.stderr.rsplit("HEAVY:", 1)[1].strip().split(",") if name]
+    return seconds, heavy
+
+
+def main():
+    parser = ArgumentParser(description="Measure the startup time of proto-sketch.")
+    parser.add_argument("--repeat", type=int, default=10, help="Runs per case (default: 10)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--check", action="store_true",
+                        help="Fail if a fast case imports matplotlib, PIL, numpy or svgwrite")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work:
+        with open(os.path.join(work, "demo.proto"), "w", encoding="utf8") as f:
+            f.write(DEMO)
+        # fill the cache of the work folder, formatting then reads it
+        run(CASES["format"], work)
+
+        results = {}
+        for name, case in CASES.items():
+            times = []
+            heavy = []
+            for _ in range(args.repeat):
+                seconds, heavy = run(case, work)
+                times.append(seconds)
+            results[name] = {
+                "median_ms": round(statistics.median(times) * 1000, 2),
+                "min_ms": round(min(times) * 1000, 2),
+                "heavy_modules": heavy,
+            }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'case':<14} {'median':>10} {'min':>10}  heavy modules")
+        for name, result in results.items():
+            print(f"{name:<14} {result['median_ms']:>8.1f}ms {result['min_ms']:>8.1f}ms  "
+                  f"{', '.join(result['heavy_modules']) or '-'}")
+
+    if args.check:
+        failures = [name for name in FAST_CASES if results[name]["heavy_modules"]]
+        if failures:
+            print(f"Heavy modules imported by: {', '.join(failures)}", file=sys.stderr)
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
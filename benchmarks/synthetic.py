@@ -0,0 +1,67 @@
+"""Synthetic protocols of scalable size for the benchmarks.
+
+    python benchmarks/synthetic.py ACTORS DRAWS [-o FILE] [--seed N]
+"""
+import random
+from argparse import ArgumentParser
+
+PLAIN_MESSAGES = [
+    "Hello", "ack", "Request data", "Send certificate", "Finished",
+    "Client key exchange", "Change cipher spec", "Verify signature",
+]
+LATEX_MESSAGES = [
+    r"$g^{a}\ \mathrm{mod}\ p$",
+    r"$H(m, k)$",
+    r"$\int_{a}^{b} x^2 dx$",
+    r"$c = E_k(m), \sigma = Sign_{sk}(c)$",
+    r"$\frac{1}{n}\sum_{i=1}^{n} x_i$",
+]
+ARROWS = ["->", "<-", "-<", ">-", "<>", "--"]
+
+
+def message(rng, index, latex_ratio, repeat_ratio):
+    # repeated labels come from small pools, the others are unique
+    if rng.random() < repeat_ratio:
+        pool = LATEX_MESSAGES if rng.random() < latex_ratio else PLAIN_MESSAGES
+        return rng.choice(pool)
+    if rng.random() < latex_ratio:
+        return f"Step {index}: ${rng.choice('abcxyz')}_{{{index}}} = {rng.choice(LATEX_MESSAGES)[1:-1]}$"
+    return f"{rng.choice(PLAIN_MESSAGES)} #{index}"
+
+
+def generate(actors, draws, seed=0, latex_ratio=0.3, self_ratio=0.2, repeat_ratio=0.5, name="synthetic"):
+    # a protocol of actors x draws with plain and latex messages and self actions
+    rng = random.Random(seed)
+    names = [f"P{i}" for i in range(actors)]
+    lines = [f"protocol {name}", ""]
+    lines += [f"actor {actor}" for actor in names]
+    lines.append("")
+    for index in range(draws):
+        text = message(rng, index, latex_ratio, repeat_ratio)
+        src = rng.choice(names)
+        if actors < 2 or rng.random() < self_ratio:
+            lines += [f"{src}:", f'    "{text}"', ""]
+        else:
+            dst = rng.choice([actor for actor in names if actor != src])
+            lines += [f"{src}{rng.choice(ARROWS)}{dst}:", f'    "{text}"', ""]
+    return "\n".join(lines)
+
+
+def main():
+    parser = ArgumentParser(description="Generate a synthetic protocol file.")
+    parser.add_argument("actors", type=int, help="Number of actors")
+    parser.add_argument("draws", type=int, help="Number of draws")
+    parser.add_argument("-o", "--output", type=str, help="Output file (default: stdout)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    args = parser.parse_args()
+
+    source = generate(args.actors, args.draws, seed=args.seed)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            f.write(source)
+    else:
+        print(source)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import os
+import sys
+import glob
+import time
+from .parser import ProtoParser
+from .proto import Picture
+from .svg import Renderer
+
+PROTO_PATTERN = "**/*.proto"
+
+# pictures shared by the protocols rendered in this process
+BATCH_PICTURES = {}
+# renderer of a worker process, built from the options of the batch
+WORKER_RENDERER = None
+# message pictures kept between the files of a batch
+MAX_PICTURES = 4096
+
+
+def expand_inputs(patterns, manifest=None):
+    # files of glob patterns, directories and manifest entries, in order
+    patterns = list(patterns or [])
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, "r", encoding="utf8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    patterns.append(line if os.path.isabs(line) else os.path.join(base, line))
+
+    files = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = sorted(glob.glob(os.path.join(pattern, PROTO_PATTERN), recursive=True))
+        elif glob.has_magic(pattern):
+            matches = sorted(glob.glob(pattern, recursive=True))
+        else:
+            matches = [pattern]
+        for file in matches:
+            if file not in files:
+                files.append(file)
+    return files
+
+
+def trim_pictures(cache=True):
+    # cached pngs are read again when drawn, so only their sizes are kept
+    global BATCH_PICTURES
+    if len(BATCH_PICTURES) > MAX_PICTURES:
+        BATCH_PICTURES = {}
+    elif cache:
+        for pic in BATCH_PICTURES.values():
+            if isinstance(pic, Picture):
+                pic.release()
+
+
+def is_batch(patterns, manifest=None):
+    # directories, glob patterns, manifests and several inputs are drawn in
+    # batch mode to an output directory, however many files they match
+    patterns = list(patterns or [])
+    if manifest or len(patterns) > 1:
+        return True
+    return any(os.path.isdir(pattern) or glob.has_magic(pattern) for pattern in patterns)
+
+
+def render_file(file, output_folder=None, output_file=None, draw=True, format=False, cache=True,
+                renderer=None):
+    renderer = renderer or WORKER_RENDERER
+    result = {"file": file, "output": None, "formatted": None, "error": None}
+    start = time.perf_counter()
+    try:
+        with open(file, "r", encoding="utf8") as f:
+            proto = ProtoParser().parse(f.read())
+        if not proto:
+            result["error"] = "Parsing failed"
+        elif format:
+            proto.preprocess(cache=cache, pictures=BATCH_PICTURES, renderer=renderer)
+            proto.width = proto.height = "auto"
+            result["formatted"] = proto.dump()
+        elif draw:
+            output_file = output_file or os.path.join(output_folder, f"{proto.name}.svg")
+            renderer.draw_protocol(proto, output_file, cache=cache, pictures=BATCH_PICTURES)
+            result["output"] = os.path.abspath(output_file)
+    except Exception as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    finally:
+        trim_pictures(cache)
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def init_worker(options):
+    # file workers render messages themselves instead of nesting pools
+    global WORKER_RENDERER
+    options.render["workers"] = 1
+    WORKER_RENDERER = Renderer(options)
+
+
+def run_batch(files, renderer, output_folder, draw=True, format=False, cache=True, jobs=1):
+    tasks = [(file, output_folder, None, draw, format, cache) for file in files]
+    if jobs <= 1 or len(files) < 2:
+        for task in tasks:
+            yield render_file(*task, renderer=renderer)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker,
+                             initargs=(renderer.options,)) as executor:
+        yield from executor.map(render_file, *zip(*tasks))
+
+
+def print_summary(results, seconds, file=sys.stderr):
+    failures = [result for result in results if result["error"]]
+    print(f"Processed {len(results)} files in {seconds:.3f}s ({len(failures)} failed)", file=file)
+    width = max([len(result["file"]) for result in results], default=0)
+    for result in results:
+        status = result["error"] or result["output"] or "ok"
+        print(f"  {result['seconds']:8.3f}s  {result['file']:<{width}}  {status}", file=file)
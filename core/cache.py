@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import threading
+from hashlib import sha256
+from functools import lru_cache
+from .utils import get_resource_path
+
+# Bump when the rasterization changes the pixels of a message
+RENDER_VERSION = 2
+
+# Fonts used by matplotlib to render messages
+FONT_FAMILY = ['Times New Roman', 'SimSun']
+MATHTEXT_FONTSET = 'stix'
+
+FONTS_DIGEST = None
+MATPLOTLIB_VERSION = None
+
+
+def fonts_digest():
+    # digest of the names, sizes and mtimes of the bundled fonts, computed
+    # once per process, hashing their contents took most of a cold start
+    global FONTS_DIGEST
+    if FONTS_DIGEST is None:
+        digest = sha256()
+        font_folder = get_resource_path("fonts")
+        for name in sorted(os.listdir(font_folder)):
+            stat = os.stat(os.path.join(font_folder, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        FONTS_DIGEST = digest.hexdigest()
+    return FONTS_DIGEST
+
+
+def matplotlib_version():
+    # version in the name of the installed dist-info folder, parsing the
+    # package metadata would take longer than the rest of a cold start
+    global MATPLOTLIB_VERSION
+    if MATPLOTLIB_VERSION is None:
+        MATPLOTLIB_VERSION = "unknown"
+        try:
+            from importlib.util import find_spec
+            site_folder = os.path.dirname(os.path.dirname(find_spec("matplotlib").origin))
+            for name in os.listdir(site_folder):
+                if name.startswith("matplotlib-") and name.endswith(".dist-info"):
+                    MATPLOTLIB_VERSION = name[len("matplotlib-"):-len(".dist-info")]
+                    break
+            else:
+                from importlib.metadata import version
+                MATPLOTLIB_VERSION = version("matplotlib")
+        except Exception:
+            pass
+    return MATPLOTLIB_VERSION
+
+
+@lru_cache(maxsize=4096)
+def cache_key(text, dpi, font_size):
+    # everything that affects the pixels of a rendered message, memoized
+    # since layout asks for the key of every draw
+    inputs = {
+        "text": text,
+        "dpi": dpi,
+        "font_size": font_size,
+        "font_family": FONT_FAMILY,
+        "mathtext_fontset": MATHTEXT_FONTSET,
+        "fonts": fonts_digest(),
+        "matplotlib": matplotlib_version(),
+        "render_version": RENDER_VERSION,
+    }
+    return sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def png_path(folder, key):
+    return os.path.join(folder, f"{key}.png")
+
+
+def meta_path(folder, key):
+    return os.path.join(folder, f"{key}.json")
+
+
+def write_file(path, data: bytes):
+    # write to a temporary file first so readers never see a partial file,
+    # one per thread as threads of a server may write the same entry
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        # another writer put the same entry in place first
+        if not os.path.exists(path):
+            raise
+
+
+def write_entry(folder, key, binary: bytes, pixel_size, bbox):
+    # the sidecar is written last, its presence marks a complete entry
+    os.makedirs(folder, exist_ok=True)
+    write_file(png_path(folder, key), binary)
+    meta = {"pixel_size": list(pixel_size), "bbox": list(bbox) if bbox else None}
+    write_file(meta_path(folder, key), json.dumps(meta).encode())
+
+
+def has_entry(folder, key):
+    return os.path.exists(meta_path(folder, key))
+
+
+def read_meta(folder, key):
+    # return the meta of a cached message without reading its png, or None on a miss
+    try:
+        with open(meta_path(folder, key), "rb") as f:
+            meta = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not os.path.exists(png_path(folder, key)):
+        return None
+    touch_entry(folder, key)
+    meta["pixel_size"] = tuple(meta["pixel_size"])
+    return meta
+
+
+####################################
+# Eviction
+####################################
+LOCK_NAME = ".lock"
+# lock files and partial writes older than this are left over by dead processes
+STALE_SECONDS = 600
+
+
+def touch_entry(folder, key):
+    # the sidecar mtime records the last access of an entry
+    try:
+        os.utime(meta_path(folder, key))
+    except OSError:
+        pass
+
+
+def acquire_lock(folder):
+    lock_path = os.path.join(folder, LOCK_NAME)
+    for _ in range(2):
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < STALE_SECONDS:
+                    return False
+                os.remove(lock_path)
+            except OSError:
+                pass
+    return False
+
+
+def release_lock(folder):
+    try:
+        os.remove(os.path.join(folder, LOCK_NAME))
+    except OSError:
+        pass
+
+
+def remove_file(path):
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
+
+
+def scan(folder):
+    # return the entries as [key, bytes, last access] and the stray files
+    entries = []
+    strays = []
+    if not os.path.isdir(folder):
+        return entries, strays
+    with os.scandir(folder) as it:
+        files = {f.name: f for f in it if f.is_file() and f.name != LOCK_NAME}
+    for name, f in files.items():
+        key, ext = os.path.splitext(name)
+        if ext == ".json":
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            size = stat.st_size
+            png = files.get(f"{key}.png")
+            if png is not None:
+                try:
+                    size += png.stat().st_size
+                except OSError:
+                    pass
+            entries.append([key, size, stat.st_mtime])
+        elif ext == ".png" and f"{key}.json" in files:
+            continue
+        else:
+            strays.append(f)
+    return entries, strays
+
+
+def stats(folder):
+    entries, strays = scan(folder)
+    accessed = [entry[2] for entry in entries]
+    return {
+        "folder": os.path.abspath(folder),
+        "entries": len(entries),
+        "bytes": sum(entry[1] for entry in entries),
+        "stray_files": len(strays),
+        "oldest_access": min(accessed) if accessed else None,
+        "newest_access": max(accessed) if accessed else None,
+    }
+
+
+def evict(folder, max_size=None, max_age=None):
+    # drop least recently used entries until the folder fits in max_size
+    # bytes and no entry is older than max_age seconds
+    removed = {"entries": 0, "bytes": 0}
+    if not acquire_lock(folder):
+        # another process is evicting the same folder
+        return removed
+    try:
+        entries, strays = scan(folder)
+        now = time.time()
+        for f in strays:
+            try:
+                if now - f.stat().st_mtime > STALE_SECONDS:
+                    removed["bytes"] += remove_file(f.path)
+            except OSError:
+                pass
+
+        entries.sort(key=lambda entry: entry[2])
+        total = sum(entry[1] for entry in entries)
+        for key, size, accessed in entries:
+            expired = max_age is not None and now - accessed > max_age
+            oversize = max_size is not None and total > max_size
+            if not expired and not oversize:
+                continue
+            # remove the sidecar first so readers see a miss, not a half entry
+            removed["bytes"] += remove_file(meta_path(folder, key))
+            removed["bytes"] += remove_file(png_path(folder, key))
+            removed["entries"] += 1
+            total -= size
+    finally:
+        release_lock(folder)
+    return removed
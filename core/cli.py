@@ -1,23 +1,175 @@
 import os
+import sys
+import time
 from argparse import ArgumentParser
 from . import __version__
-from .setting import Options
-from .proto import Protocol
-from .parser import parser as ProtoParser
-from .svg import draw_protocol, global_setting
+from .setting import Options, SERVE_PORT, SERVE_WORKERS
+
+# the parser and renderer are imported once the arguments are parsed,
+# so --version and --options-help start without loading them
+
+
+def parse_options(option_list, jobs=None, flat=False, vector_text=False, vector_math=False) -> Options:
+    # Get options from command line arguments
+    options = Options()
+    if option_list:
+        for option in option_list:
+            if '=' not in option:
+                print(f"Invalid option format: {option}. Use key=value format.")
+                exit()
+            key, value = option.split('=', 1)
+            section, _, name = key.strip().partition(":")
+            values = getattr(options, section, None)
+            if not isinstance(values, dict) or name not in values:
+                print(f"Unknown option: {key}")
+                exit()
+            # keep the type of the default value
+            if isinstance(values[name], bool):
+                values[name] = value.strip().lower() in ["1", "true", "yes", "on"]
+            else:
+                values[name] = type(values[name])(value)
+    if jobs:
+        options.render["workers"] = jobs
+    if flat:
+        options.svg["flat"] = True
+    if vector_text:
+        options.svg["vector_text"] = True
+    if vector_math:
+        options.svg["vector_math"] = True
+    options.create_folder()
+    return options
+
+
+def cache_main(argv):
+    parser = ArgumentParser(prog="proto-sketch cache", description="Manage the cache of rendered messages.")
+    parser.add_argument("--options", type=str, nargs='*', help="Set options in the format key=value")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="Show the size of the cache")
+    prune = commands.add_parser("prune", help="Remove least recently used entries")
+    prune.add_argument("--max-size", type=float, help="Maximum cache size in MB (default: cache:max_size)")
+    prune.add_argument("--max-age", type=float, help="Maximum days since last use (default: cache:max_age)")
+    prune.add_argument("--all", action="store_true", help="Remove every entry")
+    warm = commands.add_parser("warm", help="Render the messages of protocol files into the cache")
+    warm.add_argument("files", type=str, nargs='+', help="Protocol files to render")
+    warm.add_argument("-j", "--jobs", type=int,
+                      help="Number of processes used to render messages (default: render:workers)")
+    args = parser.parse_args(argv)
+    from . import cache as render_cache
+    from .parser import ProtoParser
+    from .svg import Renderer
+
+    options = parse_options(args.options, getattr(args, "jobs", None))
+    renderer = Renderer(options)
+    folder = options.folder["cache"]
+
+    if args.command == "stats":
+        stats = render_cache.stats(folder)
+        print(f"Cache folder: {stats['folder']}")
+        print(f"Entries: {stats['entries']}")
+        print(f"Size: {stats['bytes'] / 1024 / 1024:.2f} MB")
+        print(f"Stray files: {stats['stray_files']}")
+        for key in ["oldest_access", "newest_access"]:
+            if stats[key] is not None:
+                label = key.replace("_", " ").capitalize()
+                print(f"{label}: {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats[key]))}")
+    elif args.command == "prune":
+        if args.all:
+            removed = render_cache.evict(folder, max_size=0)
+        elif args.max_size is None and args.max_age is None:
+            removed = renderer.evict_cache(force=True)
+        else:
+            max_size = args.max_size if args.max_size is not None else options.cache["max_size"]
+            max_age = args.max_age if args.max_age is not None else options.cache["max_age"]
+            removed = render_cache.evict(folder, max_size=max_size * 1024 * 1024, max_age=max_age * 24 * 3600)
+        print(f"Removed {removed['entries']} entries ({removed['bytes'] / 1024 / 1024:.2f} MB)")
+    elif args.command == "warm":
+        for file in args.files:
+            if not os.path.exists(file):
+                print(f"File not found: {file}")
+                continue
+            with open(file, "r", encoding="utf8") as f:
+                proto = ProtoParser().parse(f.read(), debug=False)
+            if not proto:
+                print(f"Parsing failed: {file}")
+                continue
+            print(f"{file}: {renderer.warm_cache(proto)} messages")
+
+
+def serve_main(argv):
+    parser = ArgumentParser(prog="proto-sketch serve",
+                            description="Render protocol diagrams for editors and doc builds over local HTTP. "
+                                        "POST the source to /render for svg or to /format for formatted code.")
+    parser.add_argument("-p", "--port", type=int, default=SERVE_PORT,
+                        help=f"Port on 127.0.0.1 (default: {SERVE_PORT})")
+    parser.add_argument("-s", "--socket", type=str, help="Serve on this unix socket instead of a port")
+    parser.add_argument("-w", "--workers", type=int, default=SERVE_WORKERS,
+                        help=f"Number of processes rendering requests (default: {SERVE_WORKERS})")
+    parser.add_argument("--options", type=str, nargs='*', help="Set options in the format key=value")
+    parser.add_argument("--no-cache", action="store_true", help="Disable caching of generated images")
+    parser.add_argument("--flat", action="store_true",
+                        help="Draw elements as groups of the top-level svg instead of nested svg images")
+    parser.add_argument("--vector-text", action="store_true",
+                        help="Draw messages without formulas as svg text instead of images")
+    parser.add_argument("--vector-math", action="store_true",
+                        help="Draw messages with formulas as glyph outlines instead of images")
+    args = parser.parse_args(argv)
+
+    options = parse_options(args.options, None, args.flat, args.vector_text, args.vector_math)
+    from .svg import Renderer
+    from .server import create_server, serve
+    try:
+        server = create_server(Renderer(options), port=args.port, socket_path=args.socket,
+                               workers=args.workers, cache=not args.no_cache)
+    except FileExistsError as e:
+        print(e)
+        exit(1)
+    serve(server, args.socket)
+
 
 def main():
-    parser = ArgumentParser(description="Draw protocol diagrams from text files.")
-    parser.add_argument("-f", "--file", type=str, required=True, help="Input file to process")
+    if len(sys.argv) > 1 and sys.argv[1] == "cache":
+        cache_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        serve_main(sys.argv[2:])
+        return
+
+    parser = ArgumentParser(description="Draw protocol diagrams from text files.",
+                            epilog="Run 'proto-sketch cache -h' to manage the cache of rendered messages, "
+                                   "or 'proto-sketch serve -h' to render for editors over local HTTP.")
+    parser.add_argument("-f", "--file", type=str, nargs='+',
+                        help="Input files, directories or glob patterns to process")
+    parser.add_argument("--manifest", type=str, help="File listing input files, one per line")
     parser.add_argument("-t", "--format", action="store_true", help="Format the code before processing")
     parser.add_argument("-d", "--draw", action="store_true", help="Draw the protocol diagram")
     parser.add_argument("-o", "--output", type=str,
-                        help="Output file for the diagram (default: './proto-sketch/output/NAME.svg')")
+                        help="Output file for the diagram, gzipped if it ends with .svgz, "
+                             "or output directory for several files (default: './proto-sketch/output/NAME.svg')")
     parser.add_argument("--options", type=str, nargs='*', help="Set options in the format key=value")
     parser.add_argument("--options-help", action="store_true",
                         help="Show available options and their default values")
     parser.add_argument("--no-cache", action="store_true",
                         help="Disable caching of generated images")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of processes used to render messages (default: render:workers)")
+    parser.add_argument("--batch-jobs", type=int, default=1,
+                        help="Number of processes used to render files in batch mode (default: 1)")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Draw the protocol diagram again whenever the input file changes")
+    parser.add_argument("--flat", action="store_true",
+                        help="Draw elements as groups of the top-level svg instead of nested svg images")
+    parser.add_argument("--vector-text", action="store_true",
+                        help="Draw messages without formulas as svg text instead of images")
+    parser.add_argument("--vector-math", action="store_true",
+                        help="Draw messages with formulas as glyph outlines instead of images")
+    parser.add_argument("--stream", action="store_true",
+                        help="Draw a single large file in passes over its source, without holding all of "
+                             "its draws in memory (message pictures are kept between passes by the cache, or "
+                             "rasterized again when written with --no-cache)")
+    parser.add_argument("--stats", type=str, nargs='?', const="table", choices=["table", "json"],
+                        help="Print the time, calls and bytes of each stage to stderr as a table or JSON "
+                             "(stages run in --batch-jobs workers are not counted)")
+    parser.add_argument("--profile", type=str, help="Write a cProfile dump of the run to this file")
     parser.add_argument("-v", "--version", action="version", version=__version__, help="Show version information")
     args = parser.parse_args()
 
@@ -32,58 +184,148 @@ def main():
         }
         for key in folder_description:
             print(f"  folder:{key}={folder_description[key]}")
+        defaults = Options()
+        for section in ["pic", "actor", "action", "message", "protocol", "render", "svg", "cache"]:
+            for key, value in getattr(defaults, section).items():
+                print(f"  {section}:{key}={value}")
         exit()
 
-    # Get options from command line arguments
-    options = Options()
-    if args.options:
-        for option in args.options:
-            if '=' not in option:
-                print(f"Invalid option format: {option}. Use key=value format.")
-                exit()
-            key, value = option.split('=', 1)
-            if key.startswith("folder:"):
-                folder_key = key.replace("folder:", "").strip()
-                if folder_key in options.folder:
-                    options.folder[folder_key] = value
-                else:
-                    print(f"Unknown folder option: {key}")
-                    exit()
-            else:
-                print(f"Unknown option: {key}")
-    options.create_folder()
-    global_setting(options)
+    options = parse_options(args.options, args.jobs, args.flat, args.vector_text, args.vector_math)
+    from .stats import enable_stats, print_stats
+    if args.stats:
+        enable_stats()
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    from .svg import Renderer
+    # one renderer for the run, passed to everything that draws
+    renderer = Renderer(options)
+    try:
+        draw_main(args, options, renderer)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            print(f"Profile written to {os.path.abspath(args.profile)}", file=sys.stderr)
+        if args.stats:
+            print_stats(args.stats)
+
+
+def draw_main(args, options, renderer):
+    from .parser import ProtoParser
+    from .svg import shutdown_render_pool
+    from .batch import expand_inputs, is_batch
+    from .watch import ProtoWatcher
 
     # Check if the input file exists
-    file = args.file
-    if not file:
+    files = expand_inputs(args.file, args.manifest)
+    if not files:
         print("No file specified. Use -f or --file to specify the input file.")
         exit()
+    if is_batch(args.file, args.manifest):
+        if args.watch or args.stream:
+            print(f"{'Watch' if args.watch else 'Stream'} mode takes a single input file.")
+            exit()
+        batch_main(args, options, renderer, files)
+        return
+    file = files[0]
     if not os.path.exists(file):
         print(f"File not found: {file}")
         exit()
+    if args.stream:
+        stream_main(args, options, renderer, file)
+        return
+    if args.watch:
+        watcher = ProtoWatcher(file, options.folder["output"], args.output, cache=not args.no_cache,
+                               renderer=renderer)
+        print(f"Watching {file}, press Ctrl+C to stop", flush=True)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            shutdown_render_pool()
+        return
     with open(file, "r", encoding="utf8") as f:
         psl_code = f.read()
 
-    proto: Protocol = ProtoParser.parse(psl_code, debug=False)
+    proto = ProtoParser().parse(psl_code, debug=False)
     if not proto:
         print("Parsing failed")
         exit()
 
     using_cache = not args.no_cache
-    if args.format:
-        proto.preprocess(cache=using_cache)
-        proto.width = proto.height = "auto"
-        formatted_code = proto.dump()
-        print(formatted_code, end="")
-    elif args.draw:
+    try:
+        if args.format:
+            proto.preprocess(cache=using_cache, renderer=renderer)
+            proto.width = proto.height = "auto"
+            formatted_code = proto.dump()
+            print(formatted_code, end="")
+        elif args.draw:
+            if args.output:
+                output_file = args.output
+            else:
+                output_file = os.path.join(options.folder["output"], f"{proto.name}.svg")
+            renderer.draw_protocol(proto, output_file, cache=using_cache)
+            print(os.path.abspath(output_file))
+    except ValueError as e:
+        print(e)
+        exit()
+
+
+def stream_main(args, options, renderer, file):
+    from .stream import read_header, draw_protocol_stream
+    if not args.draw or args.format or args.watch:
+        print("Stream mode only draws, use it with -d and without -t or -w.")
+        exit()
+    try:
         if args.output:
             output_file = args.output
         else:
-            output_file = os.path.join(options.folder["output"], f"{proto.name}.svg")
-        draw_protocol(proto, output_file, cache=using_cache)
-        print(os.path.abspath(output_file))
+            output_file = os.path.join(options.folder["output"], f"{read_header(file).name}.svg")
+        draw_protocol_stream(file, output_file, cache=not args.no_cache, renderer=renderer)
+    except ValueError as e:
+        print(e)
+        exit()
+    print(os.path.abspath(output_file))
+
+
+def batch_main(args, options, renderer, files):
+    from .svg import shutdown_render_pool
+    from .batch import run_batch, print_summary
+    missing = [file for file in files if not os.path.exists(file)]
+    for file in missing:
+        print(f"File not found: {file}")
+    files = [file for file in files if file not in missing]
+
+    output_folder = args.output or options.folder["output"]
+    if args.draw and not args.format:
+        os.makedirs(output_folder, exist_ok=True)
 
+    start = time.perf_counter()
+    results = []
+    outputs = {}
+    try:
+        for result in run_batch(files, renderer, output_folder, args.draw, args.format,
+                                not args.no_cache, args.batch_jobs):
+            results.append(result)
+            if result["error"]:
+                print(f"{result['error']}: {result['file']}")
+            elif result["formatted"] is not None:
+                print(f"==> {result['file']} <==")
+                print(result["formatted"], end="")
+            elif result["output"]:
+                if result["output"] in outputs:
+                    print(f"Output of {result['file']} overwrites {outputs[result['output']]}: {result['output']}")
+                outputs[result["output"]] = result["file"]
+                print(result["output"])
+    finally:
+        shutdown_render_pool()
+    print_summary(results, time.perf_counter() - start)
+    if missing or any(result["error"] for result in results):
+        exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,5 +1,7 @@
+import copy
 from ply import lex, yacc
 from .proto import Params, Actor, Draw, Picture, Protocol, Comment
+from . import stats
 
 ##########################################################
 # 1. 词法分析器
@@ -77,16 +79,19 @@ precedence = (
     ('nonassoc', 'NEWLINE'),
 )
 
-comments = []
-last_item = None
-last_line = None
+class ParseState:
+    # comment attachment state of one parse
+    def __init__(self):
+        self.comments = []
+        self.last_item = None
+        self.last_line = None
 
 
 def p_finish(p):
     '''finish : ps'''
-    global comments
+    state = p.parser.parse_state
     p[0] = p[1]
-    for c in comments:
+    for c in state.comments:
         p[0].add(c)
 
 
@@ -101,12 +106,12 @@ def p_ps(p):
             p[0] = Protocol(p[2], Params(p[4]))
     else:
         p[0] = p[1]
-        global comments
+        state = p.parser.parse_state
         if p[2] is not None:
-            for i in comments:
+            for i in state.comments:
                 p[0].add(i)
             p[0].add(p[2])
-            comments = []
+            state.comments = []
 
 
 def p_declaration(p):
@@ -122,7 +127,9 @@ def p_declaration(p):
         item = p[1]
         line = item.lineno
 
-    global last_item, last_line, comments
+    state = p.parser.parse_state
+    comments = state.comments
+    last_item, last_line = state.last_item, state.last_line
 
     if last_item is None:
         last_item = item
@@ -172,6 +179,8 @@ def p_declaration(p):
             last_line = line
             p[0] = item
 
+    state.last_item, state.last_line = last_item, last_line
+
 
 def p_parameter(p):
     '''parameter : PARAM_GRIDX EQUAL NUMBER
@@ -239,14 +248,15 @@ def p_declaration_picture(p):
 
 def p_error(p):
     def get_error_context(p):
-        last_cr = lexer.lexdata.rfind('\n', 0, p.lexpos)
-        next_nl = lexer.lexdata.find('\n', p.lexpos)
+        lexdata = p.lexer.lexdata
+        last_cr = lexdata.rfind('\n', 0, p.lexpos)
+        next_nl = lexdata.find('\n', p.lexpos)
         if next_nl < 0:
-            next_nl = len(lexer.lexdata)
-        return lexer.lexdata[last_cr+1:next_nl]
+            next_nl = len(lexdata)
+        return lexdata[last_cr+1:next_nl]
 
     if p:
-        col = p.lexpos - lexer.line_start + 1
+        col = p.lexpos - p.lexer.line_start + 1
         print(f"Syntax error in line {p.lineno}:")
         print(f"    {get_error_context(p)}")
         print(" " * (col + 3) + "^")
@@ -254,4 +264,34 @@ def p_error(p):
         print("Syntax error at EOF")
 
 
-parser = yacc.yacc(debug=True)
+# load the tables of the packaged parsetab, without writing debug files
+lrparser = yacc.yacc(debug=False, write_tables=False)
+
+
+##########################################################
+# 3. 解析接口
+##########################################################
+
+# parser with its own lexer and comment state, use one per thread
+class ProtoParser:
+    def __init__(self):
+        self.lexer = lexer.clone()
+        self.parser = copy.copy(lrparser)
+
+    def parse(self, text, debug=False, lineno=1) -> Protocol:
+        # lineno is the line text starts on, for parts of a larger source
+        self.lexer.lineno = lineno
+        self.lexer.line_start = 0
+        self.parser.parse_state = ParseState()
+        try:
+            with stats.timer("parse"):
+                return self.parser.parse(text, lexer=self.lexer, debug=debug)
+        finally:
+            self.parser.parse_state = None
+
+
+def parse(text) -> Protocol:
+    return ProtoParser().parse(text)
+
+
+parser = ProtoParser()
@@ -1,6 +1,7 @@
 import base64
-from PIL import Image
 from typing import List, Dict
+from .utils import image_size
+from . import stats
 
 
 class Protocol:
@@ -70,23 +71,35 @@ class Protocol:
 
         return s
 
-    def preprocess(self, cache=True):
+    def messages(self):
+        # distinct messages of actors and draws, in order of appearance
+        messages = {}
+        for msg in [Message(actor.name) for actor in self.actors] + [draw.message for draw in self.draws]:
+            messages.setdefault(str(msg), msg)
+        return list(messages.values())
+
+    def preprocess(self, cache=True, pictures=None, renderer=None):
         # remove duplicates
         new_actors = []
+        names = set()
         for actor in self.actors:
-            if actor not in new_actors:
+            if actor.name not in names:
+                names.add(actor.name)
                 new_actors.append(actor)
         self.actors = new_actors
 
         # check if all draws' actors are in the actors list
         for draw in self.draws:
-            if draw.src not in self.actors:
-                self.actors.append(Actor(draw.src, Params()))
-            if draw.dst not in self.actors:
-                self.actors.append(Actor(draw.dst, Params()))
-
-        from .svg import precaculate
-        proto_size = precaculate(self, cache=cache)
+            for name in [draw.src, draw.dst]:
+                if name not in names:
+                    names.add(name)
+                    self.actors.append(Actor(name, Params()))
+
+        if renderer is None:
+            from .svg import get_renderer
+            renderer = get_renderer()
+        with stats.timer("precaculate"):
+            proto_size = renderer.precaculate(self, cache=cache, pictures=pictures)
         self.width = proto_size[0] if self.width == "auto" else self.width
         self.height = proto_size[1] if self.height == "auto" else self.height
 
@@ -141,19 +154,20 @@ class Draw:
         self.gridy = getattr(self.params, "gridy", 'auto')
         self.gridy = int(self.gridy) if self.gridy != 'auto' else self.gridy
 
+        # least grid size of the element, None to fit the message
         self.width = getattr(self.params, "width", None)
+        self.width = int(self.width) if self.width not in [None, 'auto'] else None
         self.height = getattr(self.params, "height", None)
-        if self.height == None:
-            if self.src == self.dst:
-                self.height = 9
-            else:
-                self.height = 6
+        self.height = int(self.height) if self.height not in [None, 'auto'] else None
 
         self.line_style = getattr(self.params, "line_style", None)
         self.arrow_style = getattr(self.params, "arrow_style", None)
         self.arrowl_style = getattr(self.params, "arrowl_style", None)
         self.arrowr_style = getattr(self.params, "arrowr_style", None)
 
+        # measured by the layout pass
+        self.element = None
+
     def __str__(self):
         return f"Draw: {self.src} {self.larrow} {self.rarrow} {self.dst} {self.message} {str(self.params)}"
 
@@ -195,6 +209,11 @@ class Actor:
         self.params = params
         self.gridx = getattr(params, "gridx", 'auto')
         self.gridx = int(self.gridx) if self.gridx != 'auto' else self.gridx
+        # the least gridx asked for, gridx is solved by the layout pass
+        self.min_gridx = self.gridx
+
+        # measured by the layout pass
+        self.element = None
 
     def __eq__(self, value):
         if isinstance(value, Actor):
@@ -214,32 +233,72 @@ class Actor:
         return hash(self.name)
 
     def dump_attrs(self):
-        return f"gridx={self.gridx}"
+        # the gridx asked for, the solved one would pin the actor
+        return f"gridx={self.min_gridx}"
 
     def dump(self):
         return f"actor {self.name} ({self.dump_attrs()})"
 
 
 class Picture:
-    def __init__(self, name, file, params):
+    def __init__(self, name, file, params, binary=None, pixel_size=None, render=None):
         self.lineno = None
         self.prefix_comment = None
         self.suffix_comment = None
         self.name = name
         self.file = file
 
-        # read as base64
-        with open(file, "rb") as f:
-            self.binary = f.read()
-        self.base64 = base64.b64encode(self.binary).decode("utf-8")
+        # the file is read and encoded on first use
+        self._binary = binary
+        self._base64 = None
+        self._pixel_size = pixel_size
+        # makes the file again if it was removed, as cache eviction may do
+        self.render = render
 
         width = getattr(params, "width", "auto")
         self.width = int(width) if width != "auto" else width
         height = getattr(params, "height", "auto")
         self.height = int(height) if height != "auto" else height
 
-        img = Image.open(self.file)
-        self.pixel_size = (img.size[0], img.size[1])
+    @property
+    def binary(self):
+        if self._binary is None:
+            if self.file is None:
+                # a picture drawn without the cache has no file to read
+                self._binary = self.render()
+                return self._binary
+            try:
+                with open(self.file, "rb") as f:
+                    self._binary = f.read()
+            except FileNotFoundError:
+                if self.render is None:
+                    raise
+                self._binary = self.render()
+        return self._binary
+
+    @property
+    def base64(self):
+        if self._base64 is None:
+            with stats.timer("base64"):
+                self._base64 = base64.b64encode(self.binary).decode("utf-8")
+            stats.record_bytes("base64", len(self._base64))
+        return self._base64
+
+    def release(self):
+        # drop the file contents, they are read again on next use
+        self._binary = None
+        self._base64 = None
+
+    @property
+    def pixel_size(self):
+        # only the image header is read for the size
+        if self._pixel_size is None:
+            self._pixel_size = tuple(image_size(self.file))
+        return self._pixel_size
+
+    @pixel_size.setter
+    def pixel_size(self, pixel_size):
+        self._pixel_size = pixel_size
 
     def __str__(self):
         return f"Picture: {self.name} {self.file} {self.width} {self.height}"
@@ -0,0 +1,144 @@
+import os
+import io
+import stat
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from . import __version__
+from .setting import SERVE_PORT, SERVE_WORKERS
+from .parser import ProtoParser
+from .svg import import_plt
+from . import batch
+
+# only local clients can reach the server
+HOST = "127.0.0.1"
+# largest protocol source accepted in a request
+MAX_BODY_SIZE = 8 * 1024 * 1024
+# message pictures kept by a worker between requests
+MAX_PICTURES = 4096
+
+SERVER_PICTURES = {}
+
+
+def init_server_worker(options):
+    # each worker keeps matplotlib and its fonts loaded between requests
+    batch.init_worker(options)
+    import_plt()
+
+
+def render_source(source, format=False, cache=True):
+    # run in the worker processes, returns (status, content type, body)
+    global SERVER_PICTURES
+    if len(SERVER_PICTURES) > MAX_PICTURES:
+        SERVER_PICTURES = {}
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            proto = ProtoParser().parse(source)
+        if not proto:
+            return 400, "text/plain", (log.getvalue() or "Parsing failed\n").encode()
+        if format:
+            proto.preprocess(cache=cache, pictures=SERVER_PICTURES, renderer=batch.WORKER_RENDERER)
+            proto.width = proto.height = "auto"
+            return 200, "text/plain", proto.dump().encode()
+        return 200, "image/svg+xml", batch.WORKER_RENDERER.render(proto, cache=cache, pictures=SERVER_PICTURES)
+    except Exception as e:
+        # the memo may hold what failed, it does not outlive a bad request
+        SERVER_PICTURES = {}
+        return 400, "text/plain", f"{type(e).__name__}: {e}\n".encode()
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    # POST /render and /format take protocol source and return svg or code
+    server_version = f"proto-sketch/{__version__}"
+    protocol_version = "HTTP/1.1"
+
+    def send_body(self, status, content_type, body: bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_body(200, "text/plain", b"ok\n")
+        else:
+            self.send_body(404, "text/plain", b"Not found\n")
+
+    def do_POST(self):
+        if self.path not in ["/render", "/format"]:
+            self.send_body(404, "text/plain", b"Not found\n")
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            # the body can not be told apart from the next request
+            self.close_connection = True
+            self.send_body(400, "text/plain", b"Invalid Content-Length\n")
+            return
+        if length > MAX_BODY_SIZE:
+            self.close_connection = True
+            self.send_body(413, "text/plain", b"Request too large\n")
+            return
+        try:
+            source = self.rfile.read(length).decode("utf8")
+        except UnicodeDecodeError:
+            self.send_body(400, "text/plain", b"Source must be utf-8\n")
+            return
+        future = self.server.executor.submit(render_source, source, self.path == "/format", self.server.cache)
+        self.send_body(*future.result())
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class UnixRenderHandler(RenderHandler):
+    def address_string(self):
+        return "unix"
+
+
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def create_server(renderer, port=SERVE_PORT, socket_path=None, workers=SERVE_WORKERS, cache=True):
+    from concurrent.futures import ProcessPoolExecutor
+    if socket_path:
+        if os.path.lexists(socket_path):
+            # a socket left by an earlier server, never a file given by mistake
+            if not is_socket(socket_path):
+                raise FileExistsError(f"Not a socket: {socket_path}")
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, UnixRenderHandler)
+    else:
+        server = ThreadingHTTPServer((HOST, port), RenderHandler)
+    server.cache = cache
+    server.executor = ProcessPoolExecutor(max_workers=workers, initializer=init_server_worker,
+                                          initargs=(renderer.options,))
+    # start a worker now instead of on the first request
+    server.executor.submit(int).result()
+    return server
+
+
+def serve(server, socket_path=None):
+    if socket_path:
+        print(f"Serving on unix socket {socket_path}, press Ctrl+C to stop", flush=True)
+    else:
+        host, port = server.server_address[:2]
+        print(f"Serving on http://{host}:{port}, press Ctrl+C to stop", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown()
+        if socket_path and is_socket(socket_path):
+            os.remove(socket_path)
@@ -9,6 +9,7 @@ from .utils import get_resource_path
 PIC_DPI = 600
 PIC_ZOOM = 0.125
 PIC_MARGIN = 3
+PIC_COMPRESS_LEVEL = 6  # zlib level of message pngs, 0-9
 
 # Actor Settings
 ACTOR_MIN_WIDTH = 8
@@ -21,6 +22,7 @@ ACTION_X_MARGIN = 3
 ACTION_Y_MARGIN = 1
 
 # Message Settings
+MSG_FONT_SIZE = 20
 MSG_LINE_HEIGHT = 3
 MSG_BOTTOM_MARGIN_PIXEL = 2
 
@@ -32,6 +34,23 @@ END_WIDTH = 15
 END_ZOOM = 0.2
 LINE_WIDTH = 1
 GRID_SIZE = 10
+PROTO_COMPACT = False  # draw draws without common actors on the same row
+
+# Render Settings
+RENDER_WORKERS = 1
+
+# SVG Settings
+SVG_FLAT = False
+SVG_VECTOR_TEXT = False
+SVG_VECTOR_MATH = False
+
+# Cache Settings
+CACHE_MAX_SIZE = 512  # MB
+CACHE_MAX_AGE = 30  # days
+
+# Serve Settings
+SERVE_PORT = 8765
+SERVE_WORKERS = 2
 
 # Folder Settings
 WORK_FOLDER = os.path.join(os.getcwd(), ".proto-sketch")
@@ -48,7 +67,8 @@ class Options:
         self.pic = {
             "dpi": PIC_DPI,
             "zoom": PIC_ZOOM,
-            "margin": PIC_MARGIN
+            "margin": PIC_MARGIN,
+            "compress_level": PIC_COMPRESS_LEVEL
         }
         self.actor = {
             "min_width": ACTOR_MIN_WIDTH,
@@ -61,6 +81,7 @@ class Options:
             "y_margin": ACTION_Y_MARGIN
         }
         self.message = {
+            "font_size": MSG_FONT_SIZE,
             "line_height": MSG_LINE_HEIGHT,
             "bottom_margin_pixel": MSG_BOTTOM_MARGIN_PIXEL
         }
@@ -71,7 +92,20 @@ class Options:
             "end_width": END_WIDTH,
             "end_zoom": END_ZOOM,
             "line_width": LINE_WIDTH,
-            "grid_size": GRID_SIZE
+            "grid_size": GRID_SIZE,
+            "compact": PROTO_COMPACT
+        }
+        self.render = {
+            "workers": RENDER_WORKERS
+        }
+        self.svg = {
+            "flat": SVG_FLAT,
+            "vector_text": SVG_VECTOR_TEXT,
+            "vector_math": SVG_VECTOR_MATH
+        }
+        self.cache = {
+            "max_size": CACHE_MAX_SIZE,
+            "max_age": CACHE_MAX_AGE
         }
         self.folder = {
             "work": WORK_FOLDER,
@@ -102,10 +136,11 @@ class Options:
         if output:
             self.folder["output"] = output
 
-    def set_pic(self, dpi=PIC_DPI, zoom=PIC_ZOOM, margin=PIC_MARGIN):
+    def set_pic(self, dpi=PIC_DPI, zoom=PIC_ZOOM, margin=PIC_MARGIN, compress_level=PIC_COMPRESS_LEVEL):
         self.pic["dpi"] = dpi
         self.pic["zoom"] = zoom
         self.pic["margin"] = margin
+        self.pic["compress_level"] = compress_level
 
     def set_actor(self, min_width=ACTOR_MIN_WIDTH, min_span=ACTOR_MIN_SPAN, margin=ACTOR_MARGIN):
         self.actor["min_width"] = min_width
@@ -117,11 +152,12 @@ class Options:
         self.action["x_margin"] = x_margin
         self.action["y_margin"] = y_margin
 
-    def set_message(self, line_height=MSG_LINE_HEIGHT, bottom_margin_pixel=MSG_BOTTOM_MARGIN_PIXEL):
+    def set_message(self, line_height=MSG_LINE_HEIGHT, bottom_margin_pixel=MSG_BOTTOM_MARGIN_PIXEL, font_size=MSG_FONT_SIZE):
+        self.message["font_size"] = font_size
         self.message["line_height"] = line_height
         self.message["bottom_margin_pixel"] = bottom_margin_pixel
 
-    def set_protocol(self, margin=PROTO_MARGIN, end_margin=END_MARGIN, end_height=END_HEIGHT, end_width=END_WIDTH, end_zoom=END_ZOOM, line_width=LINE_WIDTH, grid_size=GRID_SIZE):
+    def set_protocol(self, margin=PROTO_MARGIN, end_margin=END_MARGIN, end_height=END_HEIGHT, end_width=END_WIDTH, end_zoom=END_ZOOM, line_width=LINE_WIDTH, grid_size=GRID_SIZE, compact=PROTO_COMPACT):
         self.protocol["margin"] = margin
         self.protocol["end_margin"] = end_margin
         self.protocol["end_height"] = end_height
@@ -129,6 +165,19 @@ class Options:
         self.protocol["end_zoom"] = end_zoom
         self.protocol["line_width"] = line_width
         self.protocol["grid_size"] = grid_size
+        self.protocol["compact"] = compact
+
+    def set_render(self, workers=RENDER_WORKERS):
+        self.render["workers"] = workers
+
+    def set_svg(self, flat=SVG_FLAT, vector_text=SVG_VECTOR_TEXT, vector_math=SVG_VECTOR_MATH):
+        self.svg["flat"] = flat
+        self.svg["vector_text"] = vector_text
+        self.svg["vector_math"] = vector_math
+
+    def set_cache(self, max_size=CACHE_MAX_SIZE, max_age=CACHE_MAX_AGE):
+        self.cache["max_size"] = max_size
+        self.cache["max_age"] = max_age
 
     def set_folder(self, arrow="arrow", cache=CACHE_FOLDER, output=OUTPUT_FOLDER):
         self.folder["arrow"] = arrow
@@ -0,0 +1,108 @@
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# timings of the stages of a run, None unless enabled by --stats
+STATS = None
+STATS_LOCK = threading.Lock()
+
+
+class Stats:
+    def __init__(self):
+        # seconds of each call and bytes produced by stage
+        self.times = {}
+        self.bytes = {}
+        self.counters = {}
+        self.start = time.perf_counter()
+
+    def add(self, stage, seconds):
+        with STATS_LOCK:
+            self.times.setdefault(stage, []).append(seconds)
+
+    def add_bytes(self, stage, nbytes):
+        with STATS_LOCK:
+            self.bytes[stage] = self.bytes.get(stage, 0) + nbytes
+
+    def count(self, name, n=1):
+        with STATS_LOCK:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self) -> dict:
+        stages = {}
+        for stage, times in self.times.items():
+            ordered = sorted(times)
+            stages[stage] = {
+                "count": len(times),
+                "total": sum(times),
+                "mean": sum(times) / len(times),
+                "p95": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                "bytes": self.bytes.get(stage),
+            }
+        hits = self.counters.get("cache_hit", 0)
+        misses = self.counters.get("cache_miss", 0)
+        return {
+            "seconds": time.perf_counter() - self.start,
+            "stages": stages,
+            "counters": dict(self.counters),
+            "cache_hit_rate": hits / (hits + misses) if hits + misses else None,
+        }
+
+    def table(self) -> str:
+        report = self.report()
+        lines = [f"{'stage':<20} {'count':>7} {'total ms':>10} {'mean ms':>9} {'p95 ms':>9} {'bytes':>11}"]
+        for stage, row in report["stages"].items():
+            nbytes = "" if row["bytes"] is None else str(row["bytes"])
+            lines.append(f"{stage:<20} {row['count']:>7} {row['total'] * 1000:>10.2f} "
+                         f"{row['mean'] * 1000:>9.3f} {row['p95'] * 1000:>9.3f} {nbytes:>11}")
+        for name, value in report["counters"].items():
+            lines.append(f"{name:<20} {value:>7}")
+        if report["cache_hit_rate"] is not None:
+            lines.append(f"Cache hit rate: {report['cache_hit_rate'] * 100:.1f}%")
+        lines.append(f"Total: {report['seconds'] * 1000:.2f} ms")
+        return "\n".join(lines)
+
+
+def enable_stats():
+    global STATS
+    STATS = Stats()
+    return STATS
+
+
+def print_stats(format="table", file=sys.stderr):
+    if STATS is None:
+        return
+    if format == "json":
+        print(json.dumps(STATS.report(), indent=2), file=file)
+    else:
+        print(STATS.table(), file=file)
+
+
+@contextmanager
+def timer(stage):
+    # time the block as one call of stage, free when stats are disabled
+    stats = STATS
+    if stats is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.add(stage, time.perf_counter() - start)
+
+
+def record(stage, seconds):
+    if STATS is not None:
+        STATS.add(stage, seconds)
+
+
+def record_bytes(stage, nbytes):
+    if STATS is not None:
+        STATS.add_bytes(stage, nbytes)
+
+
+def count(name, n=1):
+    if STATS is not None:
+        STATS.count(name, n)
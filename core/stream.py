@@ -0,0 +1,174 @@
+import re
+import gzip
+from .parser import ProtoParser
+from .proto import Actor, Params, Picture, Protocol
+from .svg import Layout, Renderer, SvgStream, replace_file, GZIP_LEVEL
+from . import stats
+
+# texts in a chunk of the source, the declarations parsed at a time
+CHUNK_TEXTS = 256
+# a chunk after the first is parsed behind this header, on its first line
+CHUNK_HEADER = "protocol _ "
+
+# the rest of a text up to its closing quote, and the start of a text or comment
+TEXT_REST = re.compile(r'(?:\\.|[^"\\])*"')
+TEXT_OR_COMMENT = re.compile(r'["#]')
+
+
+def read_chunks(lines, texts=CHUNK_TEXTS):
+    # (first line, source) of runs of whole declarations, cut at the end of
+    # a line closing a text once there are enough texts, texts only end draws
+    # and pictures so every chunk parses alone
+    chunk, first, count = [], 1, 0
+    in_text = at_end = False
+    for lineno, line in enumerate(lines, 1):
+        chunk.append(line)
+        pos = 0
+        while pos < len(line):
+            if in_text:
+                match = TEXT_REST.match(line, pos)
+                if match is None:
+                    break
+                in_text, at_end, pos = False, True, match.end()
+                count += 1
+                continue
+            match = TEXT_OR_COMMENT.search(line, pos)
+            if line[pos:match.start() if match else len(line)].strip():
+                at_end = False
+            if match is None or match.group() == "#":
+                break
+            in_text, pos = True, match.end()
+        if at_end and not in_text and count >= texts:
+            yield first, "".join(chunk)
+            chunk, first, count = [], lineno + 1, 0
+    if chunk:
+        yield first, "".join(chunk)
+
+
+def parse_chunks(file, texts=CHUNK_TEXTS):
+    # the file as protocols of one chunk each, the first one has the header
+    parser = ProtoParser()
+    with open(file, "r", encoding="utf8") as f:
+        for index, (lineno, text) in enumerate(read_chunks(f, texts)):
+            proto = parser.parse(text if index == 0 else CHUNK_HEADER + text, lineno=lineno)
+            if not proto:
+                raise ValueError("Parsing failed")
+            yield proto
+
+
+def read_header(file) -> Protocol:
+    # the protocol of the first chunk, for its name and size
+    for proto in parse_chunks(file):
+        return proto
+    raise ValueError("Parsing failed")
+
+
+class ProtocolStream:
+    # draws a protocol file without holding all of its draws, the file is
+    # read three times: for the actors and widths, the rows and the drawing
+    def __init__(self, file, renderer=None, cache=True):
+        self.file = file
+        self.renderer = renderer or Renderer()
+        self.cache = cache
+        # without the cache message pictures are kept between the passes, only
+        # their sizes, the pngs are rasterized again when written
+        self.pictures = None if cache else {}
+        self.header = None
+        self.layout = None
+
+    def chunk_pictures(self):
+        return {} if self.pictures is None else self.pictures
+
+    def release(self, element):
+        if self.pictures is not None and isinstance(element.pic, Picture):
+            element.pic.release()
+
+    def measure_actors(self):
+        r = self.renderer
+        layout = self.layout = Layout(r)
+        # declared actors first, then the others in order of their draws
+        actors = {}
+        implicit = {}
+        for proto in parse_chunks(self.file):
+            if self.header is None:
+                self.header = proto
+            pictures = self.chunk_pictures()
+            r.render_messages(proto.messages(), cache=self.cache, pictures=pictures)
+            for actor in proto.actors:
+                actors.setdefault(actor.name, actor)
+            for draw in proto.draws:
+                r.measure_draw(draw, cache=self.cache, pictures=pictures)
+                self.release(draw.element)
+                layout.add_draw(draw)
+                implicit.setdefault(draw.src)
+                implicit.setdefault(draw.dst)
+        if self.header is None:
+            raise ValueError("Parsing failed")
+        for name in implicit:
+            actors.setdefault(name, Actor(name, Params()))
+
+        pictures = self.chunk_pictures()
+        for actor in actors.values():
+            r.measure_actor(actor, cache=self.cache, pictures=pictures)
+            self.release(actor.element)
+            layout.add_actor(actor)
+        return layout.solve_actors()
+
+    def placed_draws(self):
+        # the draws of the file measured again and placed on their rows
+        self.layout.start_rows()
+        for proto in parse_chunks(self.file):
+            pictures = self.chunk_pictures()
+            for draw in proto.draws:
+                self.renderer.measure_draw(draw, cache=self.cache, pictures=pictures)
+                self.layout.place_draw(draw)
+                yield draw
+
+    def precaculate(self):
+        proto_width = self.measure_actors()
+        # the rows are known once the actor positions are, compact rows need them
+        for _ in self.placed_draws():
+            pass
+        header = self.header
+        header.width = proto_width if header.width == "auto" else header.width
+        header.height = self.layout.height if header.height == "auto" else header.height
+        return (header.width, header.height)
+
+    def write(self, fileobj):
+        # write the svg to a binary file object, after precaculate
+        r = self.renderer
+        header, layout = self.header, self.layout
+        bottom = layout.bottom
+        actors = layout.actors
+
+        dwg = r.new_drawing(header.name, (header.width * r.grid_size, header.height * r.grid_size))
+        svg = SvgStream(dwg, fileobj)
+        actor_xpixels = r.actor_xpixels(actors)
+        r.draw_lifelines(dwg, actors, actor_xpixels, bottom)
+        r.draw_actors(dwg, actors)
+        for actor in actors:
+            self.release(actor.element)
+        svg.flush()
+        # each draw is written once placed
+        for draw in self.placed_draws():
+            r.draw_draw(dwg, draw, actor_xpixels)
+            self.release(draw.element)
+            svg.flush()
+        r.draw_ends(dwg, actors, actor_xpixels, bottom)
+        svg.close()
+        if self.cache:
+            r.evict_cache()
+
+
+def draw_protocol_stream(file, outfile, cache=True, renderer=None):
+    # .svgz files are written gzipped
+    stream = ProtocolStream(file, renderer=renderer, cache=cache)
+    # laid out before the output is opened, so a parse error leaves it alone
+    with stats.timer("precaculate"):
+        stream.precaculate()
+    with replace_file(outfile) as f:
+        if outfile.lower().endswith(".svgz"):
+            with gzip.GzipFile(filename="", mode="wb", fileobj=f, compresslevel=GZIP_LEVEL, mtime=0) as gz:
+                stream.write(gz)
+        else:
+            stream.write(f)
@@ -1,303 +1,634 @@
 import os
-import svgwrite
+import time
+import gzip
 import base64
+import threading
 from typing import Tuple
 from math import floor, ceil
+from io import BytesIO
 from hashlib import sha256
-from PIL import Image
-from .setting import Options
+from contextlib import contextmanager
+from .setting import Options, PIC_COMPRESS_LEVEL
+from . import cache as render_cache
+from . import stats
+from .text import TextPicture, FONT_FAMILY, is_plain
+from .vector import PathPicture
 from .proto import Actor, Draw, Picture, Message, Protocol, Params
 
-"""Picture Settings"""
-PIC_DPI = None
-PIC_ZOOM = None
-PIC_MARGIN = None
-
-"""Actor Settings"""
-ACTOR_MIN_WIDTH = None
-ACTOR_MIN_SPAN = None
-ACTOR_MARGIN = None
-
-"""Action Settings"""
-ACTION_MIN_WIDTH = None
-ACTION_X_MARGIN = None
-ACTION_Y_MARGIN = None
-
-"""Message Settings"""
-MSG_LINE_HEIGHT = None
-MSG_BOTTOM_MARGIN_PIXEL = None
-
-"""Protocol Settings"""
-PROTO_MARGIN = None
-END_MARGIN = None
-END_HEIGHT = None
-END_WIDTH = None
-END_ZOOM = None
-LINE_WIDTH = None
-GRID_SIZE = None
-
-"""folder settings"""
-ARROW_FOLDER = None
-CACHE_FOLDER = None
-
-
-def global_setting(options: Options):
-    """Picture Settings"""
-    global PIC_DPI, PIC_ZOOM, PIC_MARGIN
-    PIC_DPI = options.pic['dpi']
-    PIC_ZOOM = options.pic['zoom']
-    PIC_MARGIN = options.pic['margin']
-    """Actor Settings"""
-    global ACTOR_MIN_WIDTH, ACTOR_MIN_SPAN, ACTOR_MARGIN
-    ACTOR_MIN_WIDTH = options.actor['min_width']
-    ACTOR_MIN_SPAN = options.actor['min_span']
-    ACTOR_MARGIN = options.actor['margin']
-    """Action Settings"""
-    global ACTION_MIN_WIDTH, ACTION_X_MARGIN, ACTION_Y_MARGIN
-    ACTION_MIN_WIDTH = options.action['min_width']
-    ACTION_X_MARGIN = options.action['x_margin']
-    ACTION_Y_MARGIN = options.action['y_margin']
-    """Message Settings"""
-    global MSG_LINE_HEIGHT, MSG_BOTTOM_MARGIN_PIXEL
-    MSG_LINE_HEIGHT = options.message['line_height']
-    MSG_BOTTOM_MARGIN_PIXEL = options.message['bottom_margin_pixel']
-    """Protocol Settings"""
-    global PROTO_MARGIN, END_MARGIN, END_HEIGHT, END_WIDTH, END_ZOOM, LINE_WIDTH, GRID_SIZE
-    PROTO_MARGIN = options.protocol['margin']
-    END_MARGIN = options.protocol['end_margin']
-    END_HEIGHT = options.protocol['end_height']
-    END_WIDTH = options.protocol['end_width']
-    END_ZOOM = options.protocol['end_zoom']
-    LINE_WIDTH = options.protocol['line_width']
-    GRID_SIZE = options.protocol['grid_size']
-    """folder settings"""
-    global ARROW_FOLDER, CACHE_FOLDER
-    ARROW_FOLDER = options.folder['arrow']
-    CACHE_FOLDER = options.folder['cache']
-
 
 PLT = None
+# matplotlib, the bundled font and the glyph tables are shared by every
+# renderer of the process and are not thread-safe
+MPL_LOCK = threading.RLock()
 
 def import_plt():
     global PLT
-    if PLT is None:
-        import matplotlib.pyplot as plt
-        import matplotlib.font_manager as fm
-        from .utils import get_resource_path
-
-        font_folder = get_resource_path("fonts")
-        font_files = fm.findSystemFonts(fontpaths=[font_folder])
-        for font_file in font_files:
-            fm.fontManager.addfont(font_file)
-
-        plt.rcParams['font.family'] = ['Times New Roman','SimSun']
-        plt.rcParams['mathtext.fontset'] = 'stix'
-        plt.rcParams['axes.unicode_minus'] = False
-        PLT = plt
+    with MPL_LOCK:
+        if PLT is None:
+            import matplotlib.pyplot as plt
+            import matplotlib.font_manager as fm
+            from .utils import get_resource_path
+
+            font_folder = get_resource_path("fonts")
+            font_files = fm.findSystemFonts(fontpaths=[font_folder])
+            for font_file in font_files:
+                fm.fontManager.addfont(font_file)
+
+            plt.rcParams['font.family'] = render_cache.FONT_FAMILY
+            plt.rcParams['mathtext.fontset'] = render_cache.MATHTEXT_FONTSET
+            plt.rcParams['axes.unicode_minus'] = False
+            PLT = plt
     return PLT
 
 def svg_hash_name(component):
     return sha256(str(component).encode()).hexdigest()
 
-def trim_image(input_path, output_path):
-    img = Image.open(input_path)
-    img = img.convert("RGBA")
-    bbox = img.getbbox()
-    if bbox:
-        trimmed_img = img.crop(bbox)
-        trimmed_img.save(output_path)
-
-def create_message_picture(msg: Message, cache=True) -> Picture:
-    sid = svg_hash_name(msg)
-    png_path = f"{CACHE_FOLDER}/{sid}.png"
-
-    if not cache or not os.path.exists(png_path):
-        plt = import_plt()
-        fig, ax = plt.subplots(figsize=(0.01, 0.01))
-        ax.text(0.5, 0.5, msg.escape(), fontsize=20, ha='center', va='top', transform=ax.transAxes)
-        ax.axis('off')
-        fig.savefig(png_path, dpi=PIC_DPI, transparent=True, bbox_inches='tight', pad_inches=1)
-        plt.close(fig)
-        trim_image(png_path, png_path)
-
-    msg_pic = Picture(sid, png_path, Params([]))
-    msg_pic.pixel_size = (floor(msg_pic.pixel_size[0] * PIC_ZOOM),
-                          floor(msg_pic.pixel_size[1] * PIC_ZOOM))
-    return msg_pic
-
-
-def create_actor_picture(actor: Actor, gsize=10, cache=True):
-    # create message picture
-    actor_pic = create_message_picture(Message(actor.name), cache=cache)
-    # caculate size
-    size = [floor(actor_pic.pixel_size[0] / gsize) + PIC_MARGIN,
-            floor(actor_pic.pixel_size[1] / gsize) + PIC_MARGIN]
-    size[0] = size[0] if size[0] % 2 == 0 else size[0] + 1
-    size[0] = size[0] if size[0] > ACTOR_MIN_WIDTH else ACTOR_MIN_WIDTH
-    return tuple(size), actor_pic
-
-
-def create_action_picture(draw: Draw, gsize=10, cache=True):
-    assert draw.src == draw.dst, "Action picture only support self action"
-    # create message picture
-    action_pic = create_message_picture(draw.message, cache=cache)
-    # caculate size
-    size = [floor(action_pic.pixel_size[0] / gsize) + PIC_MARGIN,
-            floor(action_pic.pixel_size[1] / gsize) + PIC_MARGIN]
-    size[0] = size[0] if size[0] % 2 == 0 else size[0] + 1
-    size[0] = size[0] if size[0] > ACTION_MIN_WIDTH else ACTION_MIN_WIDTH
-    return tuple(size), action_pic
-
-
-def create_arrow_picture(draw: Draw, gsize=10, cache=True):
-    assert draw.src != draw.dst, "Arrow picture only support arrow action"
-    # create message picture
-    arrow_pic = create_message_picture(draw.message, cache=cache)
-    # caculate size
-    pic_height = ceil(ceil(arrow_pic.pixel_size[1] / GRID_SIZE) / MSG_LINE_HEIGHT) * MSG_LINE_HEIGHT
-    size = (floor(arrow_pic.pixel_size[0] / gsize) + 1, pic_height)
-    return size, arrow_pic
-
-
-def draw_picture(pic: Picture, pixel_size: Tuple[int, int]) -> str:
-    # draw picture with the pixel size
-    sid = svg_hash_name(pic)
-    dwg = svgwrite.Drawing(f"{sid}.svg", profile="tiny", size=pixel_size)
-    png_url = f"data:image/png;base64,{pic.base64}"
-    dwg.add(dwg.image(href=png_url, insert=(0, 0), size=pixel_size))
-    svg_base64 = base64.b64encode(dwg.tostring().encode()).decode("utf-8")
+def ink_bbox(pixels):
+    # box of the pixels with alpha in an rgba array, None if all are transparent
+    import numpy as np
+    alpha = pixels[:, :, 3]
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(alpha[rows[0]:rows[-1] + 1].any(axis=0))
+    return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+def encode_png(pixels, compress_level=PIC_COMPRESS_LEVEL):
+    from PIL import Image
+    buffer = BytesIO()
+    Image.fromarray(pixels, "RGBA").save(buffer, format="png", compress_level=compress_level)
+    return buffer.getvalue()
+
+class Element:
+    def __init__(self, size, pic: Picture, grid_size):
+        # grid size of the element and the message picture inside it
+        self.size = size
+        self.pic = pic
+        self.grid_size = grid_size
+        # grid row of the top of a draw, solved by the layout pass
+        self.gridy = None
+
+    @property
+    def pixel_size(self):
+        return (self.size[0] * self.grid_size, self.size[1] * self.grid_size)
+
+
+# messages used to be drawn 0.00385 inches under the top of a tight pyplot
+# figure (the text at 0.495 and the axes top at 0.88 of 0.01 inches), the
+# same fraction of a pixel keeps the lines of a message on the same pixels
+TEXT_TOP_OFFSET = 0.01 * (0.88 - 0.495)
+
+
+class MessageRasterizer:
+    # one agg canvas reused for every message, resized to each message so a
+    # large one does not slow down the small ones drawn after it
+    def __init__(self):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.transforms import IdentityTransform
+        self.figure = Figure(figsize=(1, 1))
+        self.figure.patch.set_visible(False)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.text = self.figure.text(0, 0, "", ha="center", va="top", transform=IdentityTransform())
+
+    def rasterize(self, text, dpi, font_size):
+        # rgba pixels of the message cropped to its ink, and the crop box
+        import numpy as np
+        self.text.set_text(text)
+        self.text.set_fontsize(font_size)
+        self.figure.set_dpi(dpi)
+        extent = self.text.get_window_extent(self.canvas.get_renderer())
+        # glyphs may draw outside the text extent, keep an em around it
+        margin = ceil(font_size * dpi / 72)
+        width = ceil(extent.width) + 2 * margin
+        height = ceil(extent.height) + 2 * margin + 1
+        self.figure.set_size_inches(width / dpi, height / dpi)
+        top = margin + (dpi * TEXT_TOP_OFFSET) % 1
+        self.text.set_position((margin + extent.width / 2, self.figure.bbox.height - top))
+        self.canvas.draw()
+        pixels = np.asarray(self.canvas.buffer_rgba())[:height, :width]
+        bbox = ink_bbox(pixels)
+        if bbox:
+            pixels = pixels[bbox[1]:bbox[3], bbox[0]:bbox[2]]
+        # copied, the next message draws over the canvas
+        return pixels.copy(), bbox
+
+
+RASTERIZER = None
+
+
+def rasterize_message(text, dpi, font_size, compress_level=PIC_COMPRESS_LEVEL):
+    global RASTERIZER
+    import_plt()
+    with stats.timer("rasterize"), MPL_LOCK:
+        if RASTERIZER is None:
+            RASTERIZER = MessageRasterizer()
+        pixels, bbox = RASTERIZER.rasterize(text, dpi, font_size)
+    with stats.timer("encode_png"):
+        binary = encode_png(pixels, compress_level)
+    stats.record_bytes("encode_png", len(binary))
+    return binary, (pixels.shape[1], pixels.shape[0]), bbox
+
+
+def rasterize_job(job):
+    # run in the worker processes of render_messages
+    return rasterize_message(*job)
+
+
+# process pools by number of workers, kept warm for the next protocols
+RENDER_POOLS = {}
+RENDER_POOLS_LOCK = threading.Lock()
+
+
+def get_render_pool(workers):
+    from concurrent.futures import ProcessPoolExecutor
+    with RENDER_POOLS_LOCK:
+        if workers not in RENDER_POOLS:
+            RENDER_POOLS[workers] = ProcessPoolExecutor(max_workers=workers, initializer=import_plt)
+        return RENDER_POOLS[workers]
+
+
+def shutdown_render_pool():
+    with RENDER_POOLS_LOCK:
+        for pool in RENDER_POOLS.values():
+            pool.shutdown()
+        RENDER_POOLS.clear()
+
+
+def svg_data_url(dwg) -> str:
+    with stats.timer("encode"):
+        svg_base64 = base64.b64encode(dwg.tostring().encode()).decode("utf-8")
+    stats.record_bytes("encode", len(svg_base64))
     return f"data:image/svg+xml;base64,{svg_base64}"
 
 
-def draw_actor(actor, pic: Picture, pixel_size: Tuple[int, int]) -> str:
-    # create svg
-    sid = svg_hash_name(actor)
-    dwg = svgwrite.Drawing(f"{sid}.svg", profile="tiny", size=pixel_size)
-    # calculate image insert position
-    width, height = pixel_size
-    pic_width, pic_height = pic.pixel_size
-    insert = (floor((width-pic_width)/2), floor((height-pic_height)/2)+PIC_MARGIN/2)
-    # add image
-    png_url = f"data:image/png;base64,{pic.base64}"
-    dwg.add(dwg.image(href=png_url, insert=insert, size=pic.pixel_size))
-    svg_base64 = base64.b64encode(dwg.tostring().encode()).decode("utf-8")
-    return f"data:image/svg+xml;base64,{svg_base64}"
-
-
-def draw_action(action, pic: Picture, pixel_size: Tuple[int, int]) -> str:
-    # create svg
-    sid = svg_hash_name(action)
-    dwg = svgwrite.Drawing(f"{sid}.svg", profile="tiny", size=pixel_size)
-    width, height = pixel_size
-    pic_width, pic_height = pic.pixel_size
-    insert = (floor((width-pic_width)/2), round((height-pic_height)/2))
-    # add image
-    png_url = f"data:image/png;base64,{pic.base64}"
-    dwg.add(dwg.image(href=png_url, insert=insert, size=pic.pixel_size))
-    svg_base64 = base64.b64encode(dwg.tostring().encode()).decode("utf-8")
-    return f"data:image/svg+xml;base64,{svg_base64}"
-
-
-def draw_arrow(arrow: Draw, pic: Picture, pixel_size: Tuple[int, int]) -> str:
-    # create svg
-    sid = svg_hash_name(arrow)
-    dwg = svgwrite.Drawing(f"{sid}.svg", profile="tiny", size=pixel_size)
-    # add message image
+def element_key(draw_func, pixel_size, args):
+    # what a nested svg image depends on, its message picture comes last
+    key = [args[-1].name, draw_func.__name__, tuple(pixel_size)]
+    for arg in args[:-1]:
+        key += [arg.larrow, arg.rarrow, arg.arrow_style, arg.arrowl_style, arg.arrowr_style]
+    return tuple(key)
+
+
+def add_image(dwg, parent, href, insert, size):
+    # in flat mode each distinct image is defined once and referenced by <use>
+    assets = getattr(dwg, "assets", None)
+    if assets is None:
+        parent.add(dwg.image(href=href, insert=insert, size=size))
+        return
+    # keyed by digest, so the hrefs are not kept while a drawing is streamed
+    digest = sha256(href.encode()).hexdigest()[:16]
+    key = (digest, tuple(size))
+    if key not in assets:
+        assets[key] = f"img-{digest}-{size[0]}x{size[1]}"
+        image = dwg.image(href=href, insert=(0, 0), size=size, id=assets[key])
+        dwg.defs.add(image)
+    parent.add(dwg.use(f"#{assets[key]}", insert=insert))
+
+
+def add_message(dwg, parent, pic, insert):
+    # add a message picture with its top left corner at insert
+    if isinstance(pic, TextPicture):
+        # svg tiny has no positioned <tspan>, so one <text> per line
+        center = round(insert[0] + pic.pixel_size[0] / 2, 2)
+        for line, baseline in zip(pic.lines, pic.baselines):
+            parent.add(dwg.text(line, insert=(center, round(insert[1] + baseline, 2)),
+                                font_family=FONT_FAMILY, font_size=round(pic.font_size, 2),
+                                text_anchor="middle"))
+    elif isinstance(pic, PathPicture):
+        # glyph outlines are defined once per document and placed by <use>
+        glyph_ids = getattr(dwg, "glyphs", None)
+        if glyph_ids is None:
+            glyph_ids = dwg.glyphs = {}
+        for char_id, data in pic.glyphs.items():
+            if char_id not in glyph_ids:
+                glyph_ids[char_id] = f"glyph-{sha256(char_id.encode()).hexdigest()[:16]}"
+                dwg.defs.add(dwg.path(d=data, id=glyph_ids[char_id]))
+        x = insert[0] - pic.origin[0] * pic.scale
+        y = insert[1] + pic.origin[1] * pic.scale
+        group = dwg.g(transform=f"translate({x:.2f},{y:.2f}) scale({pic.scale:.5f},{-pic.scale:.5f})")
+        for char_id, x, y, scale in pic.uses:
+            group.add(dwg.use(f"#{glyph_ids[char_id]}", transform=f"translate({x:.2f},{y:.2f}) scale({scale:.4f})"))
+        for data in pic.rects:
+            group.add(dwg.path(d=data))
+        parent.add(group)
+    else:
+        png_url = f"data:image/png;base64,{pic.base64}"
+        add_image(dwg, parent, png_url, insert, pic.pixel_size)
+
+
+def draw_picture(dwg, parent, pic: Picture, pixel_size: Tuple[int, int]):
+    # draw picture with the pixel size
     png_url = f"data:image/png;base64,{pic.base64}"
-    msg_insert = (floor((pixel_size[0] - pic.pixel_size[0])/2),
-                  floor((pixel_size[1] - pic.pixel_size[1])/2))
-    dwg.add(dwg.image(href=png_url, insert=msg_insert, size=pic.pixel_size))
-
-    # add line
-    # TODO: costomize line style
-    arrow_width = 10
-    arrow_height = 8
-    line_y = msg_insert[1] + pic.pixel_size[1] + MSG_BOTTOM_MARGIN_PIXEL
-    x0 = 0
-    x1 = pixel_size[0]
-    if arrow.larrow != '-':
-        x0 = arrow_width/2
-    if arrow.rarrow != '-':
-        x1 -= arrow_width/2
-    dwg.add(dwg.line(start=(x0, line_y), end=(x1, line_y),
-                     stroke="black", stroke_width=LINE_WIDTH))
-
-    def add_arrow(direction, arrow_x):
-        if direction == 'left':
-            arrow_svg = os.path.join(ARROW_FOLDER, "default", "left.svg")
+    add_image(dwg, parent, png_url, (0, 0), pixel_size)
+
+
+def svg_root(dwg):
+    # the document without elements, split where the elements go
+    from xml.etree import ElementTree
+    elements = dwg.elements
+    dwg.elements = []
+    try:
+        root = ElementTree.tostring(dwg.get_xml(), encoding="unicode", short_empty_elements=False)
+    finally:
+        dwg.elements = elements
+    end = root.rindex("</")
+    return '<?xml version="1.0" encoding="utf-8" ?>\n' + root[:end], root[end:]
+
+
+def write_svg(dwg, fileobj):
+    # same bytes as dwg.save(), written element by element instead of
+    # serializing the whole document to one string first
+    from xml.etree import ElementTree
+    start = time.perf_counter()
+    head, tail = svg_root(dwg)
+    written = fileobj.write(head.encode("utf-8"))
+    for element in dwg.elements:
+        written += fileobj.write(ElementTree.tostring(element.get_xml(), encoding="utf-8"))
+    written += fileobj.write(tail.encode("utf-8"))
+    stats.record("serialize", time.perf_counter() - start)
+    stats.record_bytes("serialize", written)
+
+
+@contextmanager
+def replace_file(path):
+    # write through a temporary file beside path, so an error while drawing
+    # leaves the file as it was and readers never see a partial one
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class SvgStream:
+    # writes the elements added to a drawing since the last flush and drops
+    # them, definitions added meanwhile go in a <defs> before them
+    def __init__(self, dwg, fileobj):
+        self.dwg = dwg
+        self.fileobj = fileobj
+        self.seconds = 0
+        head, self.tail = svg_root(dwg)
+        self.written = fileobj.write(head.encode("utf-8"))
+        # the first <defs> is written even if empty, as write_svg does
+        self.defs_written = False
+
+    def flush(self):
+        from xml.etree import ElementTree
+        start = time.perf_counter()
+        dwg = self.dwg
+        if dwg.defs.elements or not self.defs_written:
+            self.written += self.fileobj.write(ElementTree.tostring(dwg.defs.get_xml(), encoding="utf-8"))
+            dwg.defs.elements = []
+            self.defs_written = True
+        for element in dwg.elements[1:]:
+            self.written += self.fileobj.write(ElementTree.tostring(element.get_xml(), encoding="utf-8"))
+        del dwg.elements[1:]
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        self.flush()
+        self.written += self.fileobj.write(self.tail.encode("utf-8"))
+        stats.record("serialize", self.seconds)
+        stats.record_bytes("serialize", self.written)
+
+
+DEFAULT_ARROW_STYLE = "default"
+ARROW_STYLES = {}
+
+
+def get_arrow_style(arrow_folder, style):
+    # data urls of the arrow heads of a style, loaded once per process
+    key = (arrow_folder, style)
+    if key not in ARROW_STYLES:
+        urls = {}
+        for direction in ["left", "right"]:
+            arrow_svg = os.path.join(arrow_folder, style, f"{direction}.svg")
+            if not os.path.exists(arrow_svg):
+                raise ValueError(f"Unknown arrow style: {style}")
+            with open(arrow_svg, "rb") as f:
+                arrow_svg = base64.b64encode(f.read()).decode("utf-8")
+            urls[direction] = f"data:image/svg+xml;base64,{arrow_svg}"
+        ARROW_STYLES[key] = urls
+    return ARROW_STYLES[key]
+
+
+EVICT_INTERVAL = 60
+GZIP_LEVEL = 6
+
+
+class Renderer:
+    # settings of a diagram, renderers with different options can draw
+    # at the same time from several threads
+    def __init__(self, options: Options = None):
+        options = options or Options()
+        # kept for worker processes, which build their own renderer
+        self.options = options
+        """Picture Settings"""
+        self.pic_dpi = options.pic['dpi']
+        self.pic_zoom = options.pic['zoom']
+        self.pic_margin = options.pic['margin']
+        self.pic_compress_level = options.pic['compress_level']
+        """Actor Settings"""
+        self.actor_min_width = options.actor['min_width']
+        self.actor_min_span = options.actor['min_span']
+        self.actor_margin = options.actor['margin']
+        """Action Settings"""
+        self.action_min_width = options.action['min_width']
+        self.action_x_margin = options.action['x_margin']
+        self.action_y_margin = options.action['y_margin']
+        """Message Settings"""
+        self.msg_font_size = options.message['font_size']
+        self.msg_line_height = options.message['line_height']
+        self.msg_bottom_margin_pixel = options.message['bottom_margin_pixel']
+        """Protocol Settings"""
+        self.proto_margin = options.protocol['margin']
+        self.end_margin = options.protocol['end_margin']
+        self.end_height = options.protocol['end_height']
+        self.end_width = options.protocol['end_width']
+        self.end_zoom = options.protocol['end_zoom']
+        self.line_width = options.protocol['line_width']
+        self.grid_size = options.protocol['grid_size']
+        self.proto_compact = options.protocol['compact']
+        """Render Settings"""
+        self.render_workers = options.render['workers']
+        """SVG Settings"""
+        self.flat_svg = options.svg['flat']
+        self.vector_text = options.svg['vector_text']
+        self.vector_math = options.svg['vector_math']
+        """Cache Settings"""
+        self.cache_max_size = options.cache['max_size']
+        self.cache_max_age = options.cache['max_age']
+        """folder settings"""
+        self.arrow_folder = options.folder['arrow']
+        self.cache_folder = options.folder['cache']
+
+        self.last_eviction = None
+        self.eviction_lock = threading.Lock()
+
+    ####################################
+    # Messages
+    ####################################
+    def message_kind(self, text):
+        # how a message is drawn: svg "text", glyph "path" or "raster" image
+        if self.vector_text and is_plain(text):
+            return "text"
+        if self.vector_math and "$" in text:
+            return "path"
+        return "raster"
+
+    def message_key(self, msg: Message):
+        return render_cache.cache_key(msg.escape(), self.pic_dpi, self.msg_font_size)
+
+    def message_picture(self, sid, text, binary, pixel_size, cache=True) -> Picture:
+        png_path = render_cache.png_path(self.cache_folder, sid) if cache else None
+        msg_pic = Picture(sid, png_path, Params([]), binary=binary, pixel_size=pixel_size,
+                          render=lambda: self.rerender_message(sid, text, cache))
+        msg_pic.pixel_size = (floor(msg_pic.pixel_size[0] * self.pic_zoom),
+                              floor(msg_pic.pixel_size[1] * self.pic_zoom))
+        return msg_pic
+
+    def rerender_message(self, sid, text, cache=True) -> bytes:
+        # the png of a picture that was evicted from the cache after it was
+        # measured, or released without the cache, rasterized again
+        binary, pixel_size, bbox = rasterize_message(text, self.pic_dpi, self.msg_font_size,
+                                                     self.pic_compress_level)
+        if cache:
+            render_cache.write_entry(self.cache_folder, sid, binary, pixel_size, bbox)
+            stats.count("cache_miss")
+        return binary
+
+    def render_messages(self, messages, cache=True, pictures=None):
+        # rasterize the messages missing from the cache in a process pool
+        if self.render_workers <= 1 or pictures is None:
+            # leave it to create_message_picture
+            return pictures
+        jobs = {}
+        for msg in messages:
+            sid = self.message_key(msg)
+            if sid in jobs or (pictures is not None and sid in pictures):
+                continue
+            if cache and render_cache.has_entry(self.cache_folder, sid):
+                continue
+            if self.message_kind(msg.escape()) != "raster":
+                continue
+            jobs[sid] = (msg.escape(), self.pic_dpi, self.msg_font_size, self.pic_compress_level)
+
+        if len(jobs) < 2:
+            return pictures
+
+        if cache:
+            stats.count("cache_miss", len(jobs))
+        chunksize = ceil(len(jobs) / (self.render_workers * 4))
+        with stats.timer("render_messages"):
+            results = get_render_pool(self.render_workers).map(rasterize_job, jobs.values(), chunksize=chunksize)
+            for sid, (binary, pixel_size, bbox) in zip(jobs, results):
+                if cache:
+                    render_cache.write_entry(self.cache_folder, sid, binary, pixel_size, bbox)
+                pictures[sid] = self.message_picture(sid, jobs[sid][0], binary, pixel_size, cache)
+        return pictures
+
+    def create_message_picture(self, msg: Message, cache=True, pictures=None) -> Picture:
+        sid = self.message_key(msg)
+        if pictures is not None and sid in pictures:
+            stats.count("memo_hit")
+            return pictures[sid]
+
+        kind = self.message_kind(msg.escape())
+        if kind != "raster":
+            with stats.timer(f"message_{kind}"), MPL_LOCK:
+                if kind == "text":
+                    msg_pic = TextPicture(sid, msg.escape(), self.msg_font_size, self.pic_dpi, self.pic_zoom)
+                else:
+                    import_plt()
+                    msg_pic = PathPicture(sid, msg.escape(), self.msg_font_size, self.pic_dpi, self.pic_zoom)
+            if pictures is not None:
+                pictures[sid] = msg_pic
+            return msg_pic
+
+        # a cached png is read when the diagram is drawn, not to lay it out
+        start = time.perf_counter()
+        meta = render_cache.read_meta(self.cache_folder, sid) if cache else None
+        if meta:
+            binary, pixel_size = None, meta["pixel_size"]
         else:
-            arrow_svg = os.path.join(ARROW_FOLDER, "default", "right.svg")
-        with open(arrow_svg, "rb") as f:
-            arrow_svg = f.read()
-        arrow_svg = base64.b64encode(arrow_svg).decode("utf-8")
-        arrow_y = line_y - arrow_height/2
-        arrow_insert = (arrow_x, arrow_y)
-        arrow_url = f"data:image/svg+xml;base64,{arrow_svg}"
-        dwg.add(dwg.image(href=arrow_url, insert=arrow_insert, size=(arrow_width, arrow_height)))
-
-    # add arrow
-    # TODO: costomize arrow style
-    if arrow.larrow == '<':
-        add_arrow('left', 0)
-    elif arrow.larrow == '>':
-        add_arrow('right', 0)
-    if arrow.rarrow == '<':
-        add_arrow('left', pixel_size[0] - arrow_width)
-    elif arrow.rarrow == '>':
-        add_arrow('right', pixel_size[0] - arrow_width)
-
-    svg_base64 = base64.b64encode(dwg.tostring().encode()).decode("utf-8")
-    return f"data:image/svg+xml;base64,{svg_base64}"
-
+            binary, pixel_size, bbox = rasterize_message(msg.escape(), self.pic_dpi, self.msg_font_size,
+                                                         self.pic_compress_level)
+            if cache:
+                render_cache.write_entry(self.cache_folder, sid, binary, pixel_size, bbox)
+        msg_pic = self.message_picture(sid, msg.escape(), binary, pixel_size, cache)
+        stats.record("message_hit" if meta else "message_miss", time.perf_counter() - start)
+        if cache:
+            stats.count("cache_hit" if meta else "cache_miss")
+
+        if pictures is not None:
+            pictures[sid] = msg_pic
+        return msg_pic
+
+    def create_actor_picture(self, actor: Actor, gsize=10, cache=True, pictures=None):
+        # create message picture
+        actor_pic = self.create_message_picture(Message(actor.name), cache=cache, pictures=pictures)
+        # caculate size
+        size = [floor(actor_pic.pixel_size[0] / gsize) + self.pic_margin,
+                floor(actor_pic.pixel_size[1] / gsize) + self.pic_margin]
+        size[0] = size[0] if size[0] % 2 == 0 else size[0] + 1
+        size[0] = size[0] if size[0] > self.actor_min_width else self.actor_min_width
+        return tuple(size), actor_pic
+
+    def create_action_picture(self, draw: Draw, gsize=10, cache=True, pictures=None):
+        assert draw.src == draw.dst, "Action picture only support self action"
+        # create message picture
+        action_pic = self.create_message_picture(draw.message, cache=cache, pictures=pictures)
+        # caculate size
+        size = [floor(action_pic.pixel_size[0] / gsize) + self.pic_margin,
+                floor(action_pic.pixel_size[1] / gsize) + self.pic_margin]
+        size[0] = size[0] if size[0] % 2 == 0 else size[0] + 1
+        size[0] = size[0] if size[0] > self.action_min_width else self.action_min_width
+        return tuple(size), action_pic
+
+    def create_arrow_picture(self, draw: Draw, gsize=10, cache=True, pictures=None):
+        assert draw.src != draw.dst, "Arrow picture only support arrow action"
+        # create message picture
+        arrow_pic = self.create_message_picture(draw.message, cache=cache, pictures=pictures)
+        # caculate size
+        pic_height = ceil(ceil(arrow_pic.pixel_size[1] / self.grid_size) / self.msg_line_height) * self.msg_line_height
+        size = (floor(arrow_pic.pixel_size[0] / gsize) + 1, pic_height)
+        return size, arrow_pic
+
+    ####################################
+    # Drawing
+    ####################################
+    def place_element(self, dwg, component, insert, pixel_size, draw_func, *args, elements=None):
+        # draw a component at insert, as a group in flat mode or as a nested svg image
+        if self.flat_svg:
+            group = dwg.g(transform=f"translate({insert[0]},{insert[1]})")
+            with stats.timer(draw_func.__name__):
+                draw_func(dwg, group, *args, pixel_size)
+            dwg.add(group)
+            return
+        key = element_key(draw_func, pixel_size, args)
+        if elements is not None and key in elements:
+            href = elements[key]
+        else:
+            import svgwrite
+            sid = svg_hash_name(component)
+            inner = svgwrite.Drawing(f"{sid}.svg", profile="tiny", size=pixel_size)
+            with stats.timer(draw_func.__name__):
+                draw_func(inner, inner, *args, pixel_size)
+            href = svg_data_url(inner)
+            if elements is not None:
+                elements[key] = href
+        dwg.add(dwg.image(href=href, insert=insert, size=pixel_size))
+
+    def draw_actor(self, dwg, parent, pic: Picture, pixel_size: Tuple[int, int]):
+        # calculate image insert position
+        width, height = pixel_size
+        pic_width, pic_height = pic.pixel_size
+        insert = (floor((width-pic_width)/2), floor((height-pic_height)/2)+self.pic_margin/2)
+        # add image
+        add_message(dwg, parent, pic, insert)
+
+    def draw_action(self, dwg, parent, pic: Picture, pixel_size: Tuple[int, int]):
+        width, height = pixel_size
+        pic_width, pic_height = pic.pixel_size
+        insert = (floor((width-pic_width)/2), round((height-pic_height)/2))
+        # add image
+        add_message(dwg, parent, pic, insert)
+
+    def draw_arrow(self, dwg, parent, arrow: Draw, pic: Picture, pixel_size: Tuple[int, int]):
+        # add message image
+        msg_insert = (floor((pixel_size[0] - pic.pixel_size[0])/2),
+                      floor((pixel_size[1] - pic.pixel_size[1])/2))
+        add_message(dwg, parent, pic, msg_insert)
+
+        # add line
+        # TODO: costomize line style
+        arrow_width = 10
+        arrow_height = 8
+        line_y = msg_insert[1] + pic.pixel_size[1] + self.msg_bottom_margin_pixel
+        x0 = 0
+        x1 = pixel_size[0]
+        if arrow.larrow != '-':
+            x0 = arrow_width/2
+        if arrow.rarrow != '-':
+            x1 -= arrow_width/2
+        parent.add(dwg.line(start=(x0, line_y), end=(x1, line_y),
+                            stroke="black", stroke_width=self.line_width))
+
+        def add_arrow(style, direction, arrow_x):
+            arrow_y = line_y - arrow_height/2
+            arrow_insert = (arrow_x, arrow_y)
+            arrow_url = get_arrow_style(self.arrow_folder, style)[direction]
+            add_image(dwg, parent, arrow_url, arrow_insert, (arrow_width, arrow_height))
+
+        # add arrow
+        lstyle = arrow.arrowl_style or arrow.arrow_style or DEFAULT_ARROW_STYLE
+        rstyle = arrow.arrowr_style or arrow.arrow_style or DEFAULT_ARROW_STYLE
+        if arrow.larrow == '<':
+            add_arrow(lstyle, 'left', 0)
+        elif arrow.larrow == '>':
+            add_arrow(lstyle, 'right', 0)
+        if arrow.rarrow == '<':
+            add_arrow(rstyle, 'left', pixel_size[0] - arrow_width)
+        elif arrow.rarrow == '>':
+            add_arrow(rstyle, 'right', pixel_size[0] - arrow_width)
+
+    def new_drawing(self, name, pixel_size):
+        import svgwrite
+        # not validated, svg tiny numbers stop at 32767 and long protocols are taller
+        dwg = svgwrite.Drawing(f"{name}.svg", profile="tiny", size=pixel_size, debug=False)
+        if self.flat_svg:
+            # ids of the images in <defs>
+            dwg.assets = {}
+
+        # set background
+        # #TODO: costomize background color
+        dwg.add(dwg.rect(insert=(0, 0), size=pixel_size, fill="white"))
+        return dwg
+
+    def actor_xpixels(self, actors):
+        # x of the lifeline of each actor
+        grid_size = self.grid_size
+        return {actor.name: actor.gridx * grid_size + actor.element.pixel_size[0] / 2 for actor in actors}
+
+    def draw_lifelines(self, dwg, actors, actor_xpixels, bottom):
+        # TODO: costomize line style
+        y0 = self.proto_margin * self.grid_size
+        y1 = (bottom + self.end_margin) * self.grid_size
+        for actor in actors:
+            x = actor_xpixels[actor.name]
+            dwg.add(dwg.line(start=(x, y0), end=(x, y1), stroke="black", stroke_width=self.line_width))
+
+    def draw_actors(self, dwg, actors, elements=None):
+        proto_ypixel = self.proto_margin * self.grid_size
+        for actor in actors:
+            pixel_size = actor.element.pixel_size
+            insert = (actor.gridx * self.grid_size, proto_ypixel)
+            # add rectange
+            # TODO: costomize action style
+            dwg.add(dwg.rect(insert=insert, size=pixel_size,
+                             fill="white", stroke="black", stroke_width=self.line_width))
+            self.place_element(dwg, actor, insert, pixel_size, self.draw_actor, actor.element.pic,
+                               elements=elements)
 
-def draw_protocol(proto: Protocol, outfile: str, cache=True):
-    proto.preprocess(cache=cache)
-
-    # create svg
-    pixel_width = proto.width * GRID_SIZE
-    pixel_height = proto.height * GRID_SIZE
-    pixel_size = (pixel_width, pixel_height)
-    dwg = svgwrite.Drawing(outfile, profile="tiny", size=pixel_size)
-    
-    # set background
-    # #TODO: costomize background color
-    dwg.add(dwg.rect(insert=(0, 0), size=pixel_size, fill="white"))
-    basic_elements_num = len(dwg.elements)
-
-    # draw actors
-    actor_height = 0
-    proto_ypixel = PROTO_MARGIN * GRID_SIZE
-    actor_xpixels = {actor.name: actor.gridx * GRID_SIZE for actor in proto.actors}
-    for actor in proto.actors:
-        actor_size, actor_pic = create_actor_picture(actor, gsize=GRID_SIZE, cache=cache)
-        pixel_size = (actor_size[0] * GRID_SIZE, actor_size[1] * GRID_SIZE)
-        actor_height = pixel_size[1]
-        actor_xpixels[actor.name] += pixel_size[0] / 2
-        actor_svg = draw_actor(actor, actor_pic, pixel_size)
-        actor_xpixel = actor.gridx * GRID_SIZE
-        insert = (actor_xpixel, proto_ypixel)
-        # add rectange
-        # TODO: costomize action style
-        dwg.add(dwg.rect(insert=insert, size=pixel_size,
-                         fill="white", stroke="black", stroke_width=LINE_WIDTH))
-        dwg.add(dwg.image(href=actor_svg, insert=insert, size=pixel_size))
-
-    # draw
-    proto_ypixel += actor_height
-    for draw in proto.draws:
+    def draw_draw(self, dwg, draw, actor_xpixels, elements=None):
+        grid_size = self.grid_size
         if draw.src == draw.dst:
-            action_size, action_pic = create_action_picture(draw, gsize=GRID_SIZE, cache=cache)
-            pixel_size = (action_size[0] * GRID_SIZE, action_size[1] * GRID_SIZE)
-            action_svg = draw_action(draw, action_pic, pixel_size)
+            pixel_size = draw.element.pixel_size
             insert_xpixel = floor(actor_xpixels[draw.src] - pixel_size[0] / 2)
-            insert_ypixel = proto_ypixel + ACTION_Y_MARGIN * GRID_SIZE
-            insert = (insert_xpixel, insert_ypixel)
+            insert = (insert_xpixel, draw.element.gridy * grid_size)
             # add rectange
             # TODO: costomize action style
             dwg.add(dwg.rect(insert=insert, size=pixel_size,
-                             fill="white", stroke="black", stroke_width=LINE_WIDTH, rx=10, ry=10))
-            dwg.add(dwg.image(href=action_svg, insert=insert, size=pixel_size))
-            proto_ypixel = insert[1] + pixel_size[1]
+                             fill="white", stroke="black", stroke_width=self.line_width, rx=10, ry=10))
+            self.place_element(dwg, draw, insert, pixel_size, self.draw_action, draw.element.pic,
+                               elements=elements)
         else:
             arrow_reverse = {'<': '>', '>': '<', '-': '-'}
             if actor_xpixels[draw.src] > actor_xpixels[draw.dst]:
@@ -305,100 +636,294 @@ def draw_protocol(proto: Protocol, outfile: str, cache=True):
                 draw.larrow, draw.rarrow = draw.rarrow, draw.larrow
                 draw.larrow = arrow_reverse[draw.larrow]
                 draw.rarrow = arrow_reverse[draw.rarrow]
-            draw_size, draw_pic = create_arrow_picture(draw, gsize=GRID_SIZE, cache=cache)
+                draw.arrowl_style, draw.arrowr_style = draw.arrowr_style, draw.arrowl_style
             pixel_size = (actor_xpixels[draw.dst] -
-                          actor_xpixels[draw.src], draw_size[1] * GRID_SIZE)
-            arrow_svg = draw_arrow(draw, draw_pic, pixel_size)
-            insert = (actor_xpixels[draw.src], proto_ypixel)
-            dwg.add(dwg.image(href=arrow_svg, insert=insert, size=pixel_size))
-            proto_ypixel += pixel_size[1]
-
-    # draw line
-    # TODO: costomize line style
-    proto_ypixel += END_MARGIN * GRID_SIZE
-    y0 = PROTO_MARGIN * GRID_SIZE
-    y1 = proto_ypixel
-    for actor in proto.actors:
-        x = actor_xpixels[actor.name]
-        dwg.add(dwg.line(start=(x, y0), end=(x, y1), stroke="black", stroke_width=LINE_WIDTH))
-    line_elements = dwg.elements[-len(proto.actors):]
-    dwg.elements =  dwg.elements[:basic_elements_num] + line_elements + dwg.elements[basic_elements_num:-len(proto.actors)]
-
-    # draw end rect
-    # TODO: costomize end style
-    for actor in proto.actors:
-        x = actor_xpixels[actor.name]
-        width = END_WIDTH * GRID_SIZE * END_ZOOM
-        height = END_HEIGHT * GRID_SIZE * END_ZOOM
-        rect_insert = (x - width / 2, y1)
-        dwg.add(dwg.rect(insert=rect_insert, size=(width, height),
-                         fill="black", stroke="black", stroke_width=LINE_WIDTH))
-    dwg.save()
-
-
-def precaculate(proto: Protocol, cache=True):
-    actor_heights = []
-    item_widths = {}
-    actors = []
-
-    # Caculate actor size
-    for actor in proto.actors:
-        size, _ = create_actor_picture(actor, gsize=GRID_SIZE, cache=cache)
-        actor_heights.append(size[1])
-        item_widths[actor.name] = [size[0]]
-        actors.append(actor.name)
-    actor_height = max(actor_heights)
-
-    # Caculate action size
-    proto_height = PROTO_MARGIN + actor_height
-    for draw in proto.draws:
+                          actor_xpixels[draw.src], draw.element.pixel_size[1])
+            insert = (actor_xpixels[draw.src], draw.element.gridy * grid_size)
+            self.place_element(dwg, draw, insert, pixel_size, self.draw_arrow, draw, draw.element.pic,
+                               elements=elements)
+
+    def draw_ends(self, dwg, actors, actor_xpixels, bottom):
+        # TODO: costomize end style
+        y1 = (bottom + self.end_margin) * self.grid_size
+        for actor in actors:
+            x = actor_xpixels[actor.name]
+            width = self.end_width * self.grid_size * self.end_zoom
+            height = self.end_height * self.grid_size * self.end_zoom
+            rect_insert = (x - width / 2, y1)
+            dwg.add(dwg.rect(insert=rect_insert, size=(width, height),
+                             fill="black", stroke="black", stroke_width=self.line_width))
+
+    def create_drawing(self, proto: Protocol, cache=True, pictures=None, elements=None):
+        # pictures and elements are memos of message pictures and nested svg
+        # images, callers drawing many versions of a protocol may keep them
+        proto.preprocess(cache=cache, pictures=pictures, renderer=self)
+        grid_size = self.grid_size
+
+        # create svg
+        dwg = self.new_drawing(proto.name, (proto.width * grid_size, proto.height * grid_size))
+
+        # lowest row of the actors and the draws
+        bottom = self.proto_margin + max(actor.element.size[1] for actor in proto.actors)
+        for draw in proto.draws:
+            bottom = max(bottom, draw.element.gridy + draw.element.size[1])
+
+        # draw line, actors, draws and end rect
+        actor_xpixels = self.actor_xpixels(proto.actors)
+        self.draw_lifelines(dwg, proto.actors, actor_xpixels, bottom)
+        self.draw_actors(dwg, proto.actors, elements=elements)
+        for draw in proto.draws:
+            self.draw_draw(dwg, draw, actor_xpixels, elements=elements)
+        self.draw_ends(dwg, proto.actors, actor_xpixels, bottom)
+        return dwg
+
+    def render_to(self, proto: Protocol, fileobj, cache=True, pictures=None, elements=None, compress=False):
+        # write the svg to a binary file object, gzipped as svgz if compress
+        with stats.timer("create_drawing"):
+            dwg = self.create_drawing(proto, cache=cache, pictures=pictures, elements=elements)
+        if compress:
+            with gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, compresslevel=GZIP_LEVEL, mtime=0) as f:
+                write_svg(dwg, f)
+        else:
+            write_svg(dwg, fileobj)
+        if cache:
+            self.evict_cache()
+
+    def render(self, proto: Protocol, cache=True, pictures=None, elements=None, compress=False) -> bytes:
+        buffer = BytesIO()
+        self.render_to(proto, buffer, cache=cache, pictures=pictures, elements=elements, compress=compress)
+        return buffer.getvalue()
+
+    def draw_protocol(self, proto: Protocol, outfile: str, cache=True, pictures=None, elements=None):
+        # .svgz files are written gzipped
+        with replace_file(outfile) as f:
+            self.render_to(proto, f, cache=cache, pictures=pictures, elements=elements,
+                           compress=outfile.lower().endswith(".svgz"))
+
+    ####################################
+    # Cache
+    ####################################
+    def evict_cache(self, force=False):
+        # at most once per EVICT_INTERVAL seconds, batches draw many protocols
+        with self.eviction_lock:
+            now = time.time()
+            if not force and self.last_eviction is not None and now - self.last_eviction < EVICT_INTERVAL:
+                return {"entries": 0, "bytes": 0}
+            self.last_eviction = now
+        return render_cache.evict(self.cache_folder, max_size=self.cache_max_size * 1024 * 1024,
+                                  max_age=self.cache_max_age * 24 * 3600)
+
+    def warm_cache(self, proto: Protocol):
+        # render every message of the protocol into the cache
+        pictures = self.render_messages(proto.messages(), cache=True, pictures={})
+        for msg in proto.messages():
+            self.create_message_picture(msg, cache=True, pictures=pictures)
+        return len(pictures)
+
+    ####################################
+    # Layout
+    ####################################
+    def measure_actor(self, actor: Actor, cache=True, pictures=None):
+        size, pic = self.create_actor_picture(actor, gsize=self.grid_size, cache=cache, pictures=pictures)
+        actor.element = Element(size, pic, self.grid_size)
+
+    def check_arrow_styles(self, draw: Draw):
+        # report an unknown style with its line, before anything is drawn
+        for arrow, style in [(draw.larrow, draw.arrowl_style), (draw.rarrow, draw.arrowr_style)]:
+            style = style or draw.arrow_style or DEFAULT_ARROW_STYLE
+            if arrow in ['<', '>']:
+                try:
+                    get_arrow_style(self.arrow_folder, style)
+                except ValueError:
+                    raise ValueError(f"Unknown arrow style '{style}' in line {draw.lineno}") from None
+
+    def measure_draw(self, draw: Draw, cache=True, pictures=None):
+        if draw.src != draw.dst:
+            self.check_arrow_styles(draw)
         if draw.src == draw.dst:
-            size, _ = create_action_picture(draw, gsize=GRID_SIZE, cache=cache)
-            item_widths[draw.src].append(size[0])
+            size, pic = self.create_action_picture(draw, gsize=self.grid_size, cache=cache, pictures=pictures)
         else:
-            size, _ = create_arrow_picture(draw, gsize=GRID_SIZE, cache=cache)
-            if actors.index(draw.src) < actors.index(draw.dst):
-                item = f"{draw.src}->{draw.dst}"
-            else:
-                item = f"{draw.dst}->{draw.src}"
-            if item not in item_widths:
-                item_widths[item] = []
-            item_widths[item].append(size[0])
-        # set protocol height
-        if draw.gridy != "auto" and draw.gridy > proto_height:
-            proto_height = draw.gridy
-        proto_height += size[1]
-    proto_height += END_MARGIN + END_HEIGHT + PROTO_MARGIN
-
-    # Caculate protocol size
-    proto_width = 0
-    for i in range(len(actors)):
-        if i == 0:
-            span = PROTO_MARGIN + floor(max(item_widths[actors[i]])/2)
-            proto_width = span
+            size, pic = self.create_arrow_picture(draw, gsize=self.grid_size, cache=cache, pictures=pictures)
+        # explicit width and height are the least size
+        size = (max(size[0], draw.width or 0), max(size[1], draw.height or 0))
+        draw.element = Element(size, pic, self.grid_size)
+
+    def precaculate(self, proto: Protocol, cache=True, pictures=None):
+        # pictures of this layout pass, so each message is rendered once,
+        # callers rendering many protocols may share them between passes
+        pictures = {} if pictures is None else pictures
+        self.render_messages(proto.messages(), cache=cache, pictures=pictures)
+        layout = Layout(self)
+
+        # Caculate actor size
+        for actor in proto.actors:
+            self.measure_actor(actor, cache=cache, pictures=pictures)
+            layout.add_actor(actor)
+
+        # Caculate draw size
+        for draw in proto.draws:
+            self.measure_draw(draw, cache=cache, pictures=pictures)
+            layout.add_draw(draw)
+
+        # Caculate actor position
+        proto_width = layout.solve_actors()
+
+        # Caculate draw position
+        layout.start_rows()
+        for draw in proto.draws:
+            layout.place_draw(draw)
+
+        return (proto_width, layout.height)
+
+
+class Layout:
+    # widths and rows of a protocol, fed one measured actor and draw at a
+    # time, so a protocol can be laid out without holding all of its draws
+    def __init__(self, renderer: Renderer):
+        self.renderer = renderer
+        self.actors = []
+        # position and width of each actor
+        self.positions = {}
+        self.actor_widths = []
+        self.actor_height = 0
+        # widest action of each actor and widest message between each two
+        # actors, by name as the positions may not be known yet
+        self.action_widths = {}
+        self.message_widths = {}
+        # rows of the draws placed so far
+        self.top = self.bottom = self.start = None
+        self.slots = None
+
+    def add_actor(self, actor: Actor):
+        self.positions[actor.name] = len(self.actors)
+        self.actors.append(actor)
+        self.actor_widths.append(actor.element.size[0])
+        self.actor_height = max(self.actor_height, actor.element.size[1])
+
+    def add_draw(self, draw: Draw):
+        width = draw.element.size[0]
+        if draw.src == draw.dst:
+            self.action_widths[draw.src] = max(self.action_widths.get(draw.src, 0), width)
         else:
-            item1 = actors[i-1]
-            item2 = f"{actors[i-1]}->{actors[i]}"
-            item3 = actors[i]
+            pair = (draw.src, draw.dst) if draw.src < draw.dst else (draw.dst, draw.src)
+            self.message_widths[pair] = max(self.message_widths.get(pair, 0), width)
+
+    def solve_actors(self):
+        # each actor is the least distance right of the one before it, of
+        # the actors its messages come from and of its own gridx
+        r = self.renderer
+        actor_widths = self.actor_widths
+        action_widths = [self.action_widths.get(actor.name, 0) for actor in self.actors]
+        # widest message between each actor and the one before it, and the
+        # messages between actors further apart by the actor on the right
+        message_widths = [0] * len(self.actors)
+        reaches = {}
+        for pair, width in self.message_widths.items():
+            left, right = sorted(self.positions[name] for name in pair)
+            if right - left == 1:
+                message_widths[right] = max(message_widths[right], width)
+            else:
+                reaches.setdefault(right, []).append((left, width))
 
-            if item2 in item_widths:
-                message_width = max(item_widths[item2])
+        centers = []
+        for i, actor in enumerate(self.actors):
+            if i == 0:
+                center = r.proto_margin + floor(max(actor_widths[i], action_widths[i])/2)
             else:
-                message_width = 0
+                action_width = floor(max(action_widths[i-1], action_widths[i]) / 2) + r.action_x_margin
+                actor_width = r.actor_margin + floor(actor_widths[i-1]/2 + actor_widths[i]/2)
+
+                span = max([actor_width, action_width, message_widths[i], r.actor_min_span])
+                center = centers[i-1] + span
+                for left, width in reaches.get(i, []):
+                    center = max(center, centers[left] + width)
+            if actor.min_gridx != "auto":
+                center = max(center, actor.min_gridx + floor(actor_widths[i]/2))
+            centers.append(center)
+            actor.gridx = center - floor(actor_widths[i]/2)
+        last = len(self.actors) - 1
+        return centers[last] + r.proto_margin + floor(max(actor_widths[last], action_widths[last])/2)
+
+    def start_rows(self):
+        self.top = self.bottom = self.start = self.renderer.proto_margin + self.actor_height
+        # lowest row taken on each lifeline and between each two lifelines
+        self.slots = [self.top] * (2 * len(self.actors) - 1)
+
+    def place_draw(self, draw: Draw):
+        # a draw starts below the one before it and at its gridy, compact
+        # protocols start it on the same row if they have no actor in common
+        r = self.renderer
+        slots = self.slots
+        if not r.proto_compact:
+            self.start = self.bottom
+        elif draw.src == draw.dst:
+            index = self.positions[draw.src]
+            lo, hi = max(2 * index - 1, 0), min(2 * index + 1, len(slots) - 1)
+            self.start = max(self.start, max(slots[lo:hi+1]))
+        else:
+            lo, hi = sorted([2 * self.positions[draw.src], 2 * self.positions[draw.dst]])
+            self.start = max(self.start, max(slots[lo:hi+1]))
+        if draw.gridy != "auto":
+            self.start = max(self.start, draw.gridy)
+        draw.element.gridy = self.start + (r.action_y_margin if draw.src == draw.dst else 0)
+        draw_bottom = draw.element.gridy + draw.element.size[1]
+        if r.proto_compact:
+            slots[lo:hi+1] = [draw_bottom] * (hi - lo + 1)
+        self.bottom = max(self.bottom, draw_bottom)
+
+    @property
+    def height(self):
+        r = self.renderer
+        return self.bottom + r.end_margin + r.end_height + r.proto_margin
+
+
+####################################
+# Default renderer
+####################################
+RENDERER = None
+
+
+def global_setting(options: Options):
+    # the renderer of the module functions below
+    global RENDERER
+    RENDERER = Renderer(options)
+
+
+def get_renderer() -> Renderer:
+    global RENDERER
+    if RENDERER is None:
+        RENDERER = Renderer()
+    return RENDERER
+
+
+def message_key(msg: Message):
+    return get_renderer().message_key(msg)
+
+
+def create_message_picture(msg: Message, cache=True, pictures=None) -> Picture:
+    return get_renderer().create_message_picture(msg, cache=cache, pictures=pictures)
+
+
+def draw_protocol(proto: Protocol, outfile: str, cache=True, pictures=None, elements=None):
+    return get_renderer().draw_protocol(proto, outfile, cache=cache, pictures=pictures, elements=elements)
+
+
+def render(proto: Protocol, cache=True, pictures=None, elements=None, compress=False) -> bytes:
+    return get_renderer().render(proto, cache=cache, pictures=pictures, elements=elements, compress=compress)
+
+
+def render_to(proto: Protocol, fileobj, cache=True, pictures=None, elements=None, compress=False):
+    return get_renderer().render_to(proto, fileobj, cache=cache, pictures=pictures, elements=elements,
+                                    compress=compress)
+
 
-            actor1_width = item_widths[item1][0]
-            actor2_width = item_widths[item3][0]
-            action_widths = [0] + item_widths[item1][1:] + item_widths[item3][1:]
-            
-            action_width = floor(max(action_widths) / 2) + ACTION_X_MARGIN
-            actor_width = ACTOR_MARGIN + floor(actor1_width/2 + actor2_width/2)
+def evict_cache(force=False):
+    return get_renderer().evict_cache(force=force)
 
-            span = max([actor_width, action_width, message_width, ACTOR_MIN_SPAN])
-            proto_width += span
 
-        proto.actors[i].gridx = proto_width - floor(item_widths[actors[i]][0]/2)
+def warm_cache(proto: Protocol):
+    return get_renderer().warm_cache(proto)
 
-        if i == len(actors) - 1:
-            proto_width += PROTO_MARGIN + floor(max(item_widths[actors[i]])/2)
 
-    return (proto_width, proto_height)
+def precaculate(proto: Protocol, cache=True, pictures=None):
+    return get_renderer().precaculate(proto, cache=cache, pictures=pictures)
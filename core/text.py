@@ -0,0 +1,85 @@
+import os
+from math import floor
+from .utils import get_resource_path
+
+# Bundled font of plain messages, the first family of cache.FONT_FAMILY
+FONT_FILE = "times.ttf"
+FONT_FAMILY = "'Times New Roman', Times, serif"
+LINE_SPACING = 1.2
+
+FONT = None
+CHARMAP = None
+
+
+def get_font():
+    global FONT, CHARMAP
+    if FONT is None:
+        from matplotlib.ft2font import FT2Font
+        FONT = FT2Font(os.path.join(get_resource_path("fonts"), FONT_FILE))
+        CHARMAP = FONT.get_charmap()
+    return FONT
+
+
+def text_lines(text):
+    # lines of a message, without the blank border trimmed from rasters
+    lines = [line.strip() for line in text.split("\n")]
+    while lines and not lines[0]:
+        lines.pop(0)
+    while lines and not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def is_plain(text):
+    # text without mathtext that the bundled font can draw
+    if "$" in text:
+        return False
+    get_font()
+    return all(ord(c) in CHARMAP for c in text if c != "\n")
+
+
+def measure(font, text):
+    # ink width, height and descent of a line in pixels
+    from matplotlib.ft2font import LoadFlags
+    font.set_text(text, 0.0, flags=LoadFlags.NO_HINTING)
+    width, height = font.get_width_height()
+    return width / 64, height / 64, font.get_descent() / 64
+
+
+class TextPicture:
+    def __init__(self, name, text, font_size, dpi, zoom):
+        self.name = name
+        self.lines = text_lines(text)
+
+        # measure with the font metrics instead of rendering, following the
+        # line layout of matplotlib and the ink trimming of the rasters
+        font = get_font()
+        font.set_size(font_size, dpi)
+        _, lp_height, lp_descent = measure(font, "lp")
+        min_step = (lp_height - lp_descent) * LINE_SPACING
+        width = 0
+        top = bottom = None
+        baselines = []
+        for index, line in enumerate(self.lines):
+            ink_width, ink_height, ink_descent = measure(font, line)
+            descent = max(ink_descent, lp_descent)
+            ascent = max(ink_height, lp_height) - descent
+            if index == 0:
+                baseline = ascent
+            else:
+                baseline += last_descent + max(min_step, ascent * LINE_SPACING)
+            last_descent = descent
+            baselines.append(baseline)
+            width = max(width, ink_width)
+            ink_top = baseline - (ink_height - ink_descent)
+            ink_bottom = baseline + ink_descent
+            top = ink_top if top is None else min(top, ink_top)
+            bottom = ink_bottom if bottom is None else max(bottom, ink_bottom)
+
+        top = top or 0
+        self.font_size = font_size * dpi / 72 * zoom
+        self.baselines = [(baseline - top) * zoom for baseline in baselines]
+        self.pixel_size = (floor(width * zoom), floor(((bottom or 0) - top) * zoom))
+
+    def __str__(self):
+        return f"TextPicture: {self.name} {self.lines}"
@@ -1,11 +1,47 @@
-from pathlib import Path
-from importlib.resources import files
+import os
+import struct
 
 
 def get_resource_path(relative_path):
     """获取资源文件的绝对路径"""
+    # 安装在磁盘上时直接使用包目录, 避免导入 importlib.resources
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", relative_path)
+    if os.path.exists(path):
+        return path
     try:
+        from importlib.resources import files
         base = files("proto_sketch")
         return str(base / "data" / relative_path)
     except Exception:
-        return str(Path(__file__).parent / "data" / relative_path)
\ No newline at end of file
+        return path
+
+
+def image_size(path):
+    """读取 PNG/JPEG 文件头中的图片尺寸"""
+    with open(path, "rb") as f:
+        head = f.read(26)
+        # PNG: signature, then the IHDR chunk with width and height
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        # JPEG: walk the segments up to a start of frame marker
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    break
+                if marker[1] == 0xFF:
+                    # fill byte before the marker
+                    f.seek(-1, 1)
+                    continue
+                if marker[1] in (0x01, 0xD8) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length = struct.unpack(">H", f.read(2))[0]
+                if 0xC0 <= marker[1] <= 0xCF and marker[1] not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">xHH", f.read(5))
+                    return width, height
+                f.seek(length - 2, 1)
+    # other formats are left to PIL
+    from PIL import Image
+    with Image.open(path) as img:
+        return img.size
@@ -0,0 +1,97 @@
+from math import floor
+from .text import text_lines, LINE_SPACING
+
+TEXT_TO_PATH = None
+
+
+def get_text_to_path():
+    global TEXT_TO_PATH
+    if TEXT_TO_PATH is None:
+        from matplotlib.textpath import TextToPath
+        TEXT_TO_PATH = TextToPath()
+    return TEXT_TO_PATH
+
+
+def path_data(vertices, codes):
+    # svg path data of a matplotlib path
+    from matplotlib.path import Path
+    commands = {Path.MOVETO: "M", Path.LINETO: "L", Path.CURVE3: "Q", Path.CURVE4: "C"}
+    data = []
+    for points, code in Path(vertices, codes).iter_segments(simplify=False, curves=True):
+        if code == Path.CLOSEPOLY:
+            data.append("Z")
+        else:
+            data.append(commands[code] + " ".join(f"{v:.2f}".rstrip("0").rstrip(".") for v in points))
+    return " ".join(data)
+
+
+class PathPicture:
+    def __init__(self, name, text, font_size, dpi, zoom):
+        import numpy as np
+        from matplotlib.cbook import is_math_text
+        from matplotlib.font_manager import FontProperties, findfont, get_font
+        self.name = name
+
+        # glyphs are laid out at the size of TextToPath in units with y up,
+        # lines are stacked like the multi-line layout of matplotlib
+        text_to_path = get_text_to_path()
+        prop = FontProperties(size=text_to_path.FONT_SCALE)
+        font = get_font(findfont(prop))
+        lines = []
+        for line in text_lines(text):
+            ismath = is_math_text(line)
+            line = line if ismath else line.replace(r"\$", "$")
+            lines.append((line, ismath) + text_to_path.get_text_width_height_descent(line, prop, ismath))
+        _, lp_height, lp_descent = text_to_path.get_text_width_height_descent("lp", prop, False)
+        min_step = (lp_height - lp_descent) * LINE_SPACING
+        max_width = max([line[2] for line in lines], default=0)
+
+        glyph_map = {}
+        self.uses = []
+        rects = []
+        baseline = 0
+        for index, (line, ismath, width, height, descent) in enumerate(lines):
+            descent = max(descent, lp_descent)
+            ascent = max(height, lp_height) - descent
+            if index == 0:
+                baseline = -ascent
+            else:
+                baseline -= last_descent + max(min_step, ascent * LINE_SPACING)
+            last_descent = descent
+
+            if ismath:
+                glyphs = text_to_path.get_glyphs_mathtext(prop, line, glyph_map=glyph_map)
+            else:
+                font.set_size(text_to_path.FONT_SCALE, text_to_path.DPI)
+                glyphs = text_to_path.get_glyphs_with_font(font, line, glyph_map=glyph_map)
+            glyph_info, glyph_map, line_rects = glyphs
+            offset = (max_width - width) / 2
+            for char_id, x, y, scale in glyph_info:
+                self.uses.append((char_id, x + offset, y + baseline, scale))
+            for vertices, codes in line_rects:
+                vertices = np.array(vertices, dtype=float) + (offset, baseline)
+                rects.append((vertices, codes))
+
+        # ink bbox of the glyph outlines, blank glyphs draw nothing
+        self.uses = [use for use in self.uses if len(glyph_map[use[0]][0])]
+        extents = []
+        for char_id, x, y, scale in self.uses:
+            vertices = glyph_map[char_id][0]
+            extents.append(np.concatenate([vertices.min(0), vertices.max(0)]) * scale + (x, y, x, y))
+        for vertices, _ in rects:
+            extents.append(np.concatenate([vertices[:-1].min(0), vertices[:-1].max(0)]))
+        if extents:
+            extents = np.array(extents)
+            left, bottom = extents[:, 0].min(), extents[:, 1].min()
+            right, top = extents[:, 2].max(), extents[:, 3].max()
+        else:
+            left = bottom = right = top = 0
+
+        self.glyphs = {char_id: path_data(*glyph_map[char_id]) for char_id, _, _, _ in self.uses}
+        self.rects = [path_data(vertices, codes) for vertices, codes in rects]
+        self.origin = (left, top)
+        self.scale = font_size * dpi / 72 * zoom / text_to_path.FONT_SCALE
+        self.pixel_size = (floor((right - left) * self.scale), floor((top - bottom) * self.scale))
+
+    def __str__(self):
+        return f"PathPicture: {self.name} {len(self.uses)} glyphs"
@@ -0,0 +1,81 @@
+import os
+import time
+from hashlib import sha256
+from .parser import ProtoParser
+from .svg import Renderer
+
+POLL_INTERVAL = 0.2
+DEBOUNCE = 0.3
+
+
+def file_state(file):
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+class ProtoWatcher:
+    # redraw a protocol file when it changes, keeping the message pictures
+    # and nested svg images of the previous drawings for unchanged draws
+    def __init__(self, file, output_folder, output_file=None, cache=True, renderer=None):
+        self.file = file
+        self.renderer = renderer or Renderer()
+        self.output_folder = output_folder
+        self.output_file = output_file
+        self.cache = cache
+        self.pictures = {}
+        self.elements = {}
+        self.digest = None
+
+    def render(self):
+        # returns the output file, or None when the file is unchanged
+        with open(self.file, "r", encoding="utf8") as f:
+            psl_code = f.read()
+        digest = sha256(psl_code.encode()).hexdigest()
+        if digest == self.digest:
+            return None
+        self.digest = digest
+
+        proto = ProtoParser().parse(psl_code)
+        if not proto:
+            raise ValueError("Parsing failed")
+        output_file = self.output_file or os.path.join(self.output_folder, f"{proto.name}.svg")
+        self.renderer.draw_protocol(proto, output_file, cache=self.cache, pictures=self.pictures,
+                                    elements=self.elements)
+
+        # forget the messages removed from the file
+        sids = set(self.renderer.message_key(msg) for msg in proto.messages())
+        self.pictures = {sid: pic for sid, pic in self.pictures.items() if sid in sids}
+        self.elements = {key: href for key, href in self.elements.items() if key[0] in sids}
+        return output_file
+
+    def changed(self, state):
+        # wait until the file stays the same for DEBOUNCE seconds
+        stable_since = time.monotonic()
+        while True:
+            time.sleep(POLL_INTERVAL)
+            current = file_state(self.file)
+            if current != state:
+                state = current
+                stable_since = time.monotonic()
+            elif time.monotonic() - stable_since >= DEBOUNCE:
+                return state
+
+    def run(self):
+        state = file_state(self.file)
+        while True:
+            if state is not None:
+                start = time.perf_counter()
+                try:
+                    output_file = self.render()
+                except Exception as e:
+                    print(f"{type(e).__name__}: {e}", flush=True)
+                else:
+                    if output_file:
+                        seconds = time.perf_counter() - start
+                        print(f"{os.path.abspath(output_file)} ({seconds:.3f}s)", flush=True)
+            previous = state
+            while state == previous:
+                state = self.changed(state)